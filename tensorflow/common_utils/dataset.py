@@ -1,6 +1,9 @@
 import os
 import struct
+import contextlib
+import collections
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from common_utils import console
 
@@ -9,6 +12,19 @@ VBS2018_HEADER = [b'TRECVid\0\0\0\0\0\0\0\0\0', b'2018-01-26 10:00:00\n']
 
 DEFAULT_HEADER = [b'V3C1-FIRST750\0\0\0', b'2018-11-11 00:00:00\n']
 
+# reduced deep features - file header is followed by the magic, `REDUCED_FEATURES_HEADER`, PCA mean and
+# components (float32) used to reduce the features, image ids and matrix of L2 normalized reduced features
+REDUCED_FEATURES_MAGIC = b'KS REDUC'
+REDUCED_FEATURES_HEADER = np.dtype([('count', '<u4'), ('dimension', '<u4'), ('original_dimension', '<u4'),
+                                    ('dtype', '<u4'), ('scale', '<f4'), ('whiten', '<u4')])
+REDUCED_FEATURES_DTYPES = [np.dtype('<f2'), np.dtype('i1')]
+
+# frame manifest - file header is followed by the magic, `FRAME_MANIFEST_HEADER`, `FRAME` records sorted by image id
+# and image paths relative to the image directory, each terminated by zero byte, `path` is offset of the path
+FRAME_MANIFEST_MAGIC = b'KS FRAME'
+FRAME_MANIFEST_HEADER = np.dtype([('count', '<u4'), ('first_new_id', '<u4'), ('next_id', '<u4')])
+FRAME = np.dtype([('id', '<u4'), ('path', '<u8'), ('size', '<u8'), ('mtime', '<i8')])
+
 
 def create_file(path, struct_data_list, file_header):
     """Creates a file with a given header.
@@ -31,6 +47,27 @@ def create_file(path, struct_data_list, file_header):
     return file
 
 
+@contextlib.contextmanager
+def create_file_atomically(path, struct_data_list, file_header):
+    """Creates a file with a given header as `create_file` under a temporary name `path + '.tmp'`
+    and replaces `path` by it once it is written and synced, so that an interrupted run does not leave
+    an incomplete file and readers see either the old or the new file.
+
+    Args:
+        path: Path and name where to create the file.
+        struct_data_list: List of (data_format, data) to write to the file after the header using struct.pack().
+        file_header: File header as a list of byte strings.
+
+    Yields:
+        Handle of the temporary file.
+    """
+    with create_file(path + '.tmp', struct_data_list, file_header) as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
 def read_file(path, file_header):
     """Reads a file with a given name and header.
 
@@ -48,6 +85,70 @@ def read_file(path, file_header):
     return file
 
 
+def read_records(path, file_header=DEFAULT_HEADER):
+    """Memory-maps a file of fixed size records (id, vector) such as `.deep-features` or `.softmax` file.
+
+    Args:
+        path: Path to a file to read.
+        file_header: File header as a list of byte strings.
+
+    Returns:
+        Tuple.
+        Read-only numpy array of ids.
+        Read-only float32 matrix of vectors, one row per record.
+        Both arrays are views of the file, the data are read from disk when accessed.
+    """
+    with read_file(path, file_header) as file:
+        dimension = struct.unpack('<I', file.read(4))[0]
+        offset = file.tell()
+
+    record = np.dtype([('id', '<u4'), ('vector', '<f4', (dimension,))])
+    if os.path.getsize(path) < offset + record.itemsize:
+        return np.zeros(0, dtype='<u4'), np.zeros([0, dimension], dtype='<f4')
+
+    records = np.memmap(path, dtype=record, mode='r', offset=offset)
+    return records['id'], records['vector']
+
+
+def write_records(file, ids, vectors):
+    """Writes a batch of fixed size records (id, vector) readable by `read_records`.
+
+    Args:
+        file: Handle of the file to write to.
+        ids: Numpy array of ids.
+        vectors: Matrix of vectors, one row per id.
+    """
+    record = np.dtype([('id', '<u4'), ('vector', '<f4', (vectors.shape[1],))])
+    records = np.empty(len(ids), dtype=record)
+    records['id'] = ids
+    records['vector'] = vectors
+    records.tofile(file)
+
+
+def write_annotations(file, ids, probabilities, threshold):
+    """Writes a batch of annotation records (id, n, n class ids, n values) of classes with large probabilities.
+
+    Args:
+        file: Handle of the file to write to.
+        ids: Numpy array of image ids.
+        probabilities: Matrix of class probabilities, one row per image.
+        threshold: Classes with probability smaller than the threshold are not written.
+    """
+    images, classes = np.nonzero(probabilities >= threshold)
+    counts = np.bincount(images, minlength=len(ids))
+
+    # record of an image is 2 + 2 * (number of its classes) words long
+    starts = np.cumsum(2 + 2 * counts) - (2 + 2 * counts)
+    order = np.arange(len(images)) - (np.cumsum(counts) - counts)[images]
+
+    words = np.empty(2 * len(ids) + 2 * len(images), dtype='<u4')
+    words[starts] = ids
+    words[starts + 1] = counts
+    words[starts[images] + 2 + order] = classes
+    words.view('<f4')[starts[images] + 2 + counts[images] + order] = probabilities[images, classes]
+    words.tofile(file)
+
+
 def read_deep_features(path):
     """Reads deep features file.
 
@@ -58,44 +159,328 @@ def read_deep_features(path):
         Dictionary of tuples (id, numpy array).
     """
     d = dict()
-    file = read_file(path, DEFAULT_HEADER)
-    df_shape = struct.unpack('<I', file.read(4))[0]
+    ids, vectors = read_records(path)
 
-    byte_id = file.read(4)
-
-    while byte_id != b'':
-        file_id = struct.unpack('<I', byte_id)[0]
+    for i, file_id in enumerate(ids.tolist()):
         if file_id not in d:
             d[file_id] = []
-        d[file_id].append(np.frombuffer(file.read(df_shape * 4), dtype=np.float32))
-
-        byte_id = file.read(4)
+        d[file_id].append(vectors[i])
 
     return d
 
 
-def get_images_from_disk(directory):
+def is_reduced_features(path, file_header=DEFAULT_HEADER):
+    """
+    Args:
+        path: Path to a file to read.
+        file_header: File header as a list of byte strings.
+
+    Returns:
+        True if the file contains reduced deep features created by `processing/reduce_features.py`.
+    """
+    with read_file(path, file_header) as file:
+        return file.read(len(REDUCED_FEATURES_MAGIC)) == REDUCED_FEATURES_MAGIC
+
+
+def read_reduced_features(path, file_header=DEFAULT_HEADER):
+    """Memory-maps reduced deep features file.
+
+    Args:
+        path: Path to a file to read.
+        file_header: File header as a list of byte strings.
+
+    Returns:
+        Tuple.
+        Numpy array of image ids.
+        Read-only matrix of the reduced features as float16 or int8, one row per image.
+        Scale of the features, i.e. the features multiplied by the scale are L2 normalized.
+        PCA mean as numpy array.
+        PCA components as numpy matrix, the features are projection of the mean-centered original features.
+    """
+    with read_file(path, file_header) as file:
+        assert file.read(len(REDUCED_FEATURES_MAGIC)) == REDUCED_FEATURES_MAGIC, "Not a reduced features file!"
+        offset = file.tell()
+
+    header = np.memmap(path, dtype=REDUCED_FEATURES_HEADER, mode='r', offset=offset, shape=1)[0]
+    count, dimension, original_dimension = int(header['count']), int(header['dimension']), \
+        int(header['original_dimension'])
+    offset += REDUCED_FEATURES_HEADER.itemsize
+
+    mean = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=original_dimension)
+    offset += mean.nbytes
+    components = np.memmap(path, dtype='<f4', mode='r', offset=offset, shape=(dimension, original_dimension))
+    offset += components.nbytes
+    ids = np.memmap(path, dtype='<u4', mode='r', offset=offset, shape=count)
+    offset += ids.nbytes
+    features = np.memmap(path, dtype=REDUCED_FEATURES_DTYPES[header['dtype']], mode='r', offset=offset,
+                         shape=(count, dimension))
+
+    return ids, features, np.float32(header['scale']), mean, components
+
+
+def read_annotations(path, chunk_size=64 * 1024 * 1024):
+    """Reads annotation file generated by classification script in large chunks.
+
+    Args:
+        path: Path to a file to read.
+        chunk_size: Approximate number of bytes to read at once.
+
+    Returns:
+        Tuple.
+        Number of classes.
+        Generator of tuples (image_ids, class_ids, values) of numpy arrays,
+        one item for every (image, class) pair in the chunk.
+    """
+    file = read_file(path, DEFAULT_HEADER)
+    no_classes = struct.unpack('<I', file.read(4))[0]
+
+    return no_classes, _iterate_annotation_chunks(file, chunk_size)
+
+
+def read_annotation_offsets(path, chunk_size=64 * 1024 * 1024):
+    """Creates table of records of annotation file for random access by `read_annotation`.
+
+    Args:
+        path: Path to a file to read.
+        chunk_size: Approximate number of bytes to read at once.
+
+    Returns:
+        Tuple.
+        Number of classes.
+        Numpy array of image ids.
+        Numpy array of byte offsets of the records in the file.
+    """
+    file = read_file(path, DEFAULT_HEADER)
+    no_classes = struct.unpack('<I', file.read(4))[0]
+
+    ids, offsets = [], []
+    with file:
+        position = file.tell()
+        remainder = b''
+        while True:
+            data = file.read(chunk_size)
+            if data == b'':
+                break
+            buffer = remainder + data
+
+            starts, _, end = _find_records(buffer)
+            ids.append(np.frombuffer(buffer, dtype='<u4', count=end // 4)[starts // 4])
+            offsets.append(starts + position)
+
+            remainder = buffer[end:]
+            position += end
+
+    assert remainder == b'', "Annotation file is truncated!"
+    return no_classes, np.concatenate(ids + [np.zeros(0, '<u4')]), np.concatenate(offsets + [np.zeros(0, np.int64)])
+
+
+def read_annotation(data, offset):
+    """Reads one record of annotation file.
+
+    Args:
+        data: Annotation file memory-mapped as uint8 numpy array.
+        offset: Byte offset of the record from `read_annotation_offsets`.
+
+    Returns:
+        Tuple of numpy arrays (class_ids, values) that are views of the file.
+    """
+    no_indexes = int(data[offset + 4:offset + 8].view('<u4')[0])
+    class_ids = data[offset + 8:offset + 8 + 4 * no_indexes].view('<u4')
+    values = data[offset + 8 + 4 * no_indexes:offset + 8 + 8 * no_indexes].view('<f4')
+    return class_ids, values
+
+
+def _find_records(buffer):
+    """Finds boundaries of complete annotation records in a buffer, only record headers are visited.
+
+    Args:
+        buffer: Bytes starting with a record.
+
+    Returns:
+        Tuple.
+        Numpy array of byte offsets of the records.
+        Numpy array of number of classes of each record.
+        Byte offset after the last complete record.
+    """
+    starts, lengths = [], []
+    position = 0
+    while position + 8 <= len(buffer):
+        no_indexes = struct.unpack_from('<I', buffer, position + 4)[0]
+        end = position + 8 + 8 * no_indexes
+        if end > len(buffer):
+            break
+        starts.append(position)
+        lengths.append(no_indexes)
+        position = end
+
+    return np.array(starts, dtype=np.int64), np.array(lengths, dtype=np.int64), position
+
+
+def _iterate_annotation_chunks(file, chunk_size):
+    """Parses records of an annotation file chunk by chunk.
+
+    Args:
+        file: Handle to start of the records.
+        chunk_size: Approximate number of bytes to read at once.
+
+    Yields:
+        Tuples (image_ids, class_ids, values) of numpy arrays.
+    """
+    remainder = b''
+
+    with file:
+        while True:
+            data = file.read(chunk_size)
+            if data == b'':
+                break
+            buffer = remainder + data
+
+            starts, lengths, position = _find_records(buffer)
+            starts //= 4
+            remainder = buffer[position:]
+
+            words = np.frombuffer(buffer, dtype='<u4', count=position // 4)
+            floats = np.frombuffer(buffer, dtype='<f4', count=position // 4)
+
+            # position of each class index in `words` is its record start + 2 + its order within the record
+            record_of_item = np.repeat(np.arange(len(starts)), lengths)
+            first_item = np.cumsum(lengths) - lengths
+            class_positions = starts[record_of_item] + 2 + np.arange(len(record_of_item)) - first_item[record_of_item]
+
+            yield words[starts[record_of_item]], words[class_positions], \
+                floats[class_positions + lengths[record_of_item]]
+
+    assert remainder == b'', "Annotation file is truncated!"
+
+
+def scan_images(directory, stat=True, no_threads=16):
+    """Lists files in subfolders of a folder, the subfolders are listed in parallel.
+
+    Args:
+        directory: Folder to read from.
+        stat: If true, sizes and modification times of the files are returned as well.
+        no_threads: Number of subfolders listed at once, network file systems profit from many threads.
+
+    Returns:
+        Tuple.
+        List of file paths relative to the folder sorted by subfolder and file name.
+        Numpy array of file sizes or None.
+        Numpy array of file modification times in nanoseconds or None.
+    """
+    with os.scandir(directory) as entries:
+        folders = sorted(entry.name for entry in entries if entry.is_dir())
+
+    def scan_folder(folder):
+        with os.scandir(os.path.join(directory, folder)) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        stats = [entry.stat() for entry in entries] if stat else []
+        return [os.path.join(folder, entry.name) for entry in entries], \
+            [s.st_size for s in stats], [s.st_mtime_ns for s in stats]
+
+    pt = console.ProgressTracker()
+    pt.info(">> Reading image files...")
+    pt.reset(len(folders))
+
+    paths, sizes, mtimes = [], [], []
+    with ThreadPoolExecutor(no_threads) as executor:
+        for folder_paths, folder_sizes, folder_mtimes in executor.map(scan_folder, folders):
+            paths += folder_paths
+            sizes += folder_sizes
+            mtimes += folder_mtimes
+            pt.increment()
+
+    if not stat:
+        return paths, None, None
+    return paths, np.array(sizes, dtype=np.uint64), np.array(mtimes, dtype=np.int64)
+
+
+def get_images_from_disk(directory, first_id=0, no_threads=16):
     """Reads files in folder.
 
     Args:
         directory: Folder to read from.
+        first_id: Id of the first image, e.g. the next id after images of already indexed videos.
+        no_threads: Number of subfolders listed at once.
 
     Returns:
         Dictionary of tuples (file_absolute_path, id).
     """
     directory = os.path.normpath(directory)
-    image_id = 0
-    res = dict()
+    paths, _, _ = scan_images(directory, stat=False, no_threads=no_threads)
+    return {os.path.join(directory, path): image_id for image_id, path in enumerate(paths, first_id)}
 
-    sorted_list = sorted(os.listdir(directory))
-    pt = console.ProgressTracker()
-    pt.info(">> Reading image files...")
-    pt.reset(len(sorted_list))
-
-    for folder in sorted_list:
-        if os.path.isdir(os.path.join(directory, folder)):
-            for image in sorted(os.listdir(os.path.join(directory, folder))):
-                res[os.path.join(directory, folder, image)] = image_id
-                image_id += 1
-        pt.increment()
-    return res
+
+def read_frame_manifest(path, file_header=DEFAULT_HEADER):
+    """Reads frame manifest created by `processing/scan_images.py`.
+
+    Args:
+        path: Path to a file to read.
+        file_header: File header as a list of byte strings.
+
+    Returns:
+        Tuple.
+        Read-only numpy array of `FRAME` records (id, path offset, size, modification time) sorted by id.
+        List of image paths relative to the image directory, one for each record.
+        Id of the first image added by the last scan.
+        Id of the next image to add.
+    """
+    with read_file(path, file_header) as file:
+        assert file.read(len(FRAME_MANIFEST_MAGIC)) == FRAME_MANIFEST_MAGIC, "Not a frame manifest file!"
+        offset = file.tell()
+
+    header = np.memmap(path, dtype=FRAME_MANIFEST_HEADER, mode='r', offset=offset, shape=1)[0]
+    count = int(header['count'])
+    offset += FRAME_MANIFEST_HEADER.itemsize
+
+    records = np.zeros(0, dtype=FRAME)
+    if count > 0:
+        records = np.memmap(path, dtype=FRAME, mode='r', offset=offset, shape=count)
+    offset += FRAME.itemsize * count
+
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        paths = file.read().decode('utf-8', 'surrogateescape').split('\0')[:count]
+
+    return records, paths, int(header['first_new_id']), int(header['next_id'])
+
+
+def read_video_starts(path):
+    """Reads boundaries of videos from frame manifest, images of a video are in one subfolder.
+
+    Images of every video must have consecutive ids, which does not hold once images of an existing video
+    were changed, `processing/scan_images.py` gives them new ids after all other images.
+
+    Args:
+        path: Path to the frame manifest.
+
+    Returns:
+        Sorted numpy array of the id of the first image of every video.
+    """
+    records, paths, _, _ = read_frame_manifest(path)
+    folders = [os.path.dirname(image) for image in paths]
+
+    starts = [i for i in range(len(folders)) if i == 0 or folders[i] != folders[i - 1]]
+    if len(starts) != len(set(folders)):
+        split = collections.Counter(folders[i] for i in starts).most_common(1)[0][0]
+        raise Exception("Images of video " + split + " in " + path + " do not have consecutive ids, "
+                        "create a new frame manifest and index to use video boundaries.")
+    return np.asarray(records['id'][starts], dtype=np.int64)
+
+
+def get_images_from_manifest(directory, path, new_only=False):
+    """Reads images of a frame manifest without listing the folder.
+
+    Args:
+        directory: Folder of the images given to `processing/scan_images.py`.
+        path: Path to the frame manifest.
+        new_only: If true, only images that were new or changed in the last scan are returned.
+
+    Returns:
+        Dictionary of tuples (file_absolute_path, id).
+    """
+    directory = os.path.normpath(directory)
+    records, paths, first_new_id, _ = read_frame_manifest(path)
+
+    ids = records['id'].tolist()
+    return {os.path.join(directory, image): image_id for image_id, image in zip(ids, paths)
+            if not new_only or image_id >= first_new_id}
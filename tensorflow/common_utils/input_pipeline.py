@@ -1,7 +1,14 @@
+import os
 import tensorflow as tf
 
 from models import inception_preprocessing
 
+try:
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+except AttributeError:
+    # tf.data.experimental is available since TensorFlow 1.13
+    AUTOTUNE = os.cpu_count()
+
 
 class ImageReader:
     """
@@ -98,6 +105,39 @@ def make_batch_from_jpeg(filenames, batch_size=80, use_large=False):
                               allow_smaller_final_batch=True)
 
 
+def make_dataset_from_jpeg(filenames, batch_size=80, use_large=False):
+    """Creates a read op in a TensorFlow graph that returns batches of jpeg images read and decoded in parallel.
+
+    Args:
+        filenames: Jpeg filenames or dictionary with the filenames as keys.
+        batch_size: Size of each batch, the last batch can be smaller.
+
+    Returns:
+        Tuple (image_names, images) of batch size, each image name is read together with the image.
+    """
+    wh = 224
+    if use_large:
+        wh = 331
+
+    def preprocess(key, image):
+        image = tf.image.decode_jpeg(image, channels=3)
+        return key, inception_preprocessing.preprocess_image(image, wh, wh, is_training=False,
+                                                             central_fraction=False)
+
+    with tf.name_scope('InceptionPreprocessing'):
+        if isinstance(filenames, dict):
+            filenames = list(filenames.keys())
+
+        # explicit dtype so that an empty list, e.g. when resuming a completed run, is a dataset of strings
+        ds = tf.data.Dataset.from_tensor_slices(tf.constant(filenames, dtype=tf.string))
+        ds = ds.map(lambda key: (key, tf.read_file(key)), num_parallel_calls=AUTOTUNE)
+        ds = ds.map(preprocess, num_parallel_calls=AUTOTUNE)
+        ds = ds.batch(batch_size)
+        ds = ds.prefetch(AUTOTUNE)
+
+        return ds.make_one_shot_iterator().get_next()
+
+
 def make_batch(filenames, batch_size, is_training, repeat=True, use_large=False):
     """Creates a read op in a TensorFlow graph that returns individual batches from tfrecord files.
 
@@ -0,0 +1,206 @@
+import numpy as np
+
+INDEX_MAGIC = b'KS INDEX'
+INDEX_MAGIC_V2 = b'KS INDX2'
+SEPARATOR = b'\xff\xff\xff\xff\xff\xff\xff\xff'
+
+POSTING = np.dtype([('id', '<u4'), ('score', '<f4')])
+
+# version 2 - header is followed by the table of classes, each class consists of
+# block descriptions, quantized scores padded to 8 bytes and bit-packed image id differences
+HEADER_V2 = np.dtype([('block_size', '<u4'), ('score_bytes', '<u4'), ('no_classes', '<u4'), ('padding', '<u4')])
+CLASS_V2 = np.dtype([('class', '<u4'), ('count', '<u4'), ('scale', '<f4'), ('no_blocks', '<u4'), ('offset', '<u8')])
+BLOCK_V2 = np.dtype([('first_id', '<u4'), ('max_score', '<f4'), ('bits', '<u4'), ('ids_offset', '<u4')])
+
+
+class InvertedIndex:
+    """
+    A class reading inverted index file created by `processing/create_index.py`.
+    The file is memory-mapped, only the postings that are accessed are read from disk.
+
+    Postings of a class are sorted by descending score in version 1 of the index.
+    In version 2, postings are split into blocks sorted by descending score,
+    postings in each block are sorted by image id.
+    """
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename: Path to the inverted index file.
+        """
+        self._buffer = np.memmap(filename, dtype=np.uint8, mode='r')
+
+        if len(self._buffer) >= 8 and self._buffer[:8].tobytes() == INDEX_MAGIC_V2:
+            self._read_table_v2()
+        else:
+            self._read_table()
+
+    def _read_table(self):
+        """
+        Reads class-to-offset table of version 1 of the index.
+        """
+        self.version = 1
+        self.block_size = None
+
+        if len(self._buffer) < 24 or self._buffer[:8].tobytes() != INDEX_MAGIC \
+                or self._buffer[8:16].tobytes() != SEPARATOR:
+            raise Exception("Invalid index file format.")
+
+        # the first class starts right after the class-to-offset map
+        first_entry = self._buffer[16:24].view('<u4')
+        if first_entry[0] == 0xffffffff:
+            no_entries = 0
+        else:
+            no_entries = (int(first_entry[1]) - 24) // 8
+
+        table = self._buffer[16:16 + no_entries * 8].view([('class', '<u4'), ('offset', '<u4')])
+        if self._buffer[16 + no_entries * 8:24 + no_entries * 8].tobytes() != SEPARATOR:
+            raise Exception("Invalid index file format.")
+
+        self._starts = table['offset'].astype(np.int64)
+
+        # each class ends with a separator right before the next class starts
+        order = np.argsort(self._starts)
+        ends = np.empty_like(self._starts)
+        ends[order] = np.append(self._starts[order][1:], len(self._buffer)) - 8
+        self._counts = (ends - self._starts) // POSTING.itemsize
+
+        self._classes = {class_id: i for i, class_id in enumerate(table['class'].tolist())}
+
+    def _read_table_v2(self):
+        """
+        Reads table of classes of version 2 of the index.
+        """
+        self.version = 2
+
+        header = self._buffer[8:8 + HEADER_V2.itemsize].view(HEADER_V2)[0]
+        self.block_size = int(header['block_size'])
+        self._score_dtype = np.dtype('<u1') if header['score_bytes'] == 1 else np.dtype('<u2')
+
+        start = 8 + HEADER_V2.itemsize
+        self._table = self._buffer[start:start + int(header['no_classes']) * CLASS_V2.itemsize].view(CLASS_V2)
+        self._counts = self._table['count'].astype(np.int64)
+
+        self._classes = {class_id: i for i, class_id in enumerate(self._table['class'].tolist())}
+
+    def __len__(self):
+        return len(self._classes)
+
+    def __contains__(self, class_id):
+        return class_id in self._classes
+
+    def __getitem__(self, class_id):
+        return self.postings(class_id)
+
+    @property
+    def classes(self):
+        """
+        Returns:
+            List of class ids in the index.
+        """
+        return list(self._classes.keys())
+
+    def count(self, class_id):
+        """
+        Args:
+            class_id: Class id as in the label file.
+
+        Returns:
+            Number of images in the class.
+        """
+        if class_id not in self._classes:
+            return 0
+        return int(self._counts[self._classes[class_id]])
+
+    def postings(self, class_id, start=0, stop=None):
+        """
+        Args:
+            class_id: Class id as in the label file.
+            start: Position of the first posting to return.
+            stop: Position after the last posting to return, all postings till the end if None.
+
+        Returns:
+            Array of `POSTING` (image id, score). In version 1, the array is a read-only view
+            of the file sorted by descending score. Empty array if the class is not in the index.
+        """
+        if class_id not in self._classes:
+            return np.zeros(0, dtype=POSTING)
+
+        i = self._classes[class_id]
+        stop = self._counts[i] if stop is None else min(stop, self._counts[i])
+        start = min(start, stop)
+
+        if self.version == 2:
+            return self._decode_v2(i, start, stop)
+
+        offset = self._starts[i]
+        return self._buffer[offset:offset + self._counts[i] * POSTING.itemsize].view(POSTING)[start:stop]
+
+    def score_bound(self, class_id, position):
+        """
+        Args:
+            class_id: Class id as in the label file.
+            position: Position of a posting.
+
+        Returns:
+            Upper bound of scores of the postings from the position till the end of the class.
+        """
+        if position >= self.count(class_id):
+            return np.float32(0)
+
+        i = self._classes[class_id]
+        if self.version == 2:
+            return self._blocks_v2(i)['max_score'][position // self.block_size]
+
+        offset = self._starts[i] + position * POSTING.itemsize
+        return self._buffer[offset:offset + POSTING.itemsize].view(POSTING)['score'][0]
+
+    def _blocks_v2(self, i):
+        """
+        Returns:
+            Array of `BLOCK_V2` of i-th class in the table.
+        """
+        offset = int(self._table['offset'][i])
+        return self._buffer[offset:offset + int(self._table['no_blocks'][i]) * BLOCK_V2.itemsize].view(BLOCK_V2)
+
+    def _decode_v2(self, i, start, stop):
+        """
+        Decodes postings of i-th class in the table of version 2 of the index.
+
+        Returns:
+            Array of `POSTING` from position `start` to `stop`.
+        """
+        entry = self._table[i]
+        blocks = self._blocks_v2(i)
+        block_size = self.block_size
+
+        scores_offset = int(entry['offset']) + len(blocks) * BLOCK_V2.itemsize
+        scores_length = int(entry['count']) * self._score_dtype.itemsize
+        ids_offset = scores_offset + (scores_length + 7) // 8 * 8
+
+        first_block = start // block_size
+        last_block = (stop + block_size - 1) // block_size
+        blocks = blocks[first_block:last_block]
+
+        # image ids are the first id of the block plus cumulative sum of bit-packed differences
+        differences = np.zeros([len(blocks), block_size], dtype=np.uint32)
+        for bits in np.unique(blocks['bits']).tolist():
+            if bits == 0:
+                continue
+            selected = np.flatnonzero(blocks['bits'] == bits)
+            positions = ids_offset + blocks['ids_offset'][selected].astype(np.int64)[:, np.newaxis] + \
+                np.arange(block_size * bits // 8)
+            # the last block is not padded, positions after the end of the file are never used
+            packed = self._buffer[np.minimum(positions, len(self._buffer) - 1)]
+            unpacked = np.unpackbits(packed, axis=1).reshape([len(selected), block_size, bits])
+            differences[selected] = unpacked.dot(np.left_shift(1, np.arange(bits - 1, -1, -1)).astype(np.uint32))
+
+        ids = (np.cumsum(differences, axis=1, dtype=np.uint32) + blocks['first_id'][:, np.newaxis]).ravel()
+        ids = ids[start - first_block * block_size:stop - first_block * block_size]
+
+        scores = self._buffer[scores_offset:scores_offset + scores_length].view(self._score_dtype)[start:stop]
+
+        photos = np.empty(stop - start, dtype=POSTING)
+        photos['id'] = ids
+        photos['score'] = scores.astype(np.float32) * entry['scale']
+        return photos
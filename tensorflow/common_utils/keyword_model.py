@@ -0,0 +1,287 @@
+import struct
+import collections
+import numpy as np
+
+from common_utils import dataset
+from common_utils.inverted_index import InvertedIndex
+from common_utils.segmented_index import SegmentedIndex, is_manifest
+from common_utils.window import sparse_table, range_max, get_video_ends
+from common_utils.dataset import DEFAULT_HEADER
+HEADER = DEFAULT_HEADER
+
+
+def read_idf(filename, file_header=HEADER):
+    """Reads sum of softmax values created by classification script and computes IDF
+    the same way as the UI application, i.e. :math:`\\log\\left(\\frac{\\max_c c}{c}\\right) + 1`.
+
+    Args:
+        filename: Location of the `.sumX` file.
+        file_header: File header as a list of byte strings.
+
+    Returns:
+        Numpy array of IDF for each class.
+    """
+    with dataset.read_file(filename, file_header) as f:
+        dimension = struct.unpack('<I', f.read(4))[0]
+        term_count = np.frombuffer(f.read(dimension * 4), dtype='<f4')
+
+    return (np.log(np.amax(term_count) / term_count) + 1).astype(np.float32)
+
+
+class KeywordModel:
+    """
+    Ranks images by a query in conjunctive normal form the same way as `KeywordModel` of the UI application.
+    Scores of classes in a clause are summed (weighted by IDF if used), scores of clauses are multiplied.
+    """
+    MAX_CACHE_SIZE = 100
+
+    def __init__(self, index, idf=None, video_starts=None):
+        """
+        Args:
+            index: `InvertedIndex` or `SegmentedIndex` object, a location of the inverted index file
+                or a manifest of the segmented index.
+            idf: Numpy array of IDF for each class or None if IDF should not be used.
+            video_starts: Sorted numpy array of the id of the first image of every video, see
+                `dataset.read_video_starts`, or None if temporal queries should not respect videos.
+        """
+        if isinstance(index, str):
+            index = SegmentedIndex(index) if is_manifest(index) else InvertedIndex(index)
+        self.index = index
+        self.idf = idf
+        self.video_starts = video_starts
+        self._lookup_cache = collections.OrderedDict()
+
+    def rank(self, query, top_k=None):
+        """
+        Args:
+            query: List of clauses, each clause is a list of class ids.
+            top_k: Number of the best images to return, all images are returned if None.
+
+        Returns:
+            Tuple of numpy arrays of image ids and their scores sorted by descending score.
+        """
+        ids, scores = self._get_scores(query)
+        return KeywordModel._top_k(ids, scores, top_k)
+
+    def rank_temporal(self, query, next_query, window, top_k=None):
+        """Finds images matching a query that are followed by an image matching the next query in the same video.
+        Score of an image is its score multiplied by the best score of the next query in the window of `window`
+        images starting at the image, as the temporal ranking of the simulation.
+
+        Args:
+            query: List of clauses of the first image, each clause is a list of class ids.
+            next_query: List of clauses of the following image.
+            window: Number of images in the window including the first image.
+            top_k: Number of the best images to return, all images are returned if None.
+
+        Returns:
+            Tuple of numpy arrays of image ids of the first images and their scores sorted by descending score.
+        """
+        ids, scores = self._get_scores(query)
+        next_ids, next_scores = self._get_scores(next_query)
+
+        starts = ids.astype(np.int64)
+        stops = starts + window
+        if self.video_starts is not None:
+            stops = np.minimum(stops, get_video_ends(self.video_starts, starts))
+
+        # both lists are sorted by id, next images in the window of an image are a range of the next list
+        first = np.searchsorted(next_ids, starts)
+        last = np.searchsorted(next_ids, stops)
+        found = last > first
+
+        next_best = range_max(sparse_table(next_scores, window), first[found], last[found])
+        return KeywordModel._top_k(ids[found], scores[found] * next_best, top_k)
+
+    def rank_threshold(self, query, top_k, block_size=1024):
+        """Finds the best images without reading whole classes (Fagin's no random access algorithm).
+
+        Postings of all classes are read in blocks of growing size by descending score. Scores of an image in
+        classes where it was not read yet are bounded by the score of the last read posting of the class, so each
+        seen image has a lower and an upper bound of its score. The reading stops once the `top_k` best lower
+        bounds are at least the upper bound of any other image, including the images that were not seen yet.
+        The best images may still miss scores in clauses with several classes, only these scores are read
+        by random access, which loads the whole class.
+
+        Args:
+            query: List of clauses, each clause is a list of class ids.
+            top_k: Number of the best images to return.
+            block_size: Number of postings of each class to read in the first step.
+
+        Returns:
+            Tuple of numpy arrays of at most `top_k` image ids and their scores sorted by descending score,
+            images with the same score may differ from `rank`.
+        """
+        if len(query) == 0 or top_k <= 0:
+            return np.zeros(0, np.uint32), np.zeros(0, np.float32)
+
+        classes = [class_id for clause in query for class_id in clause]
+        clause_starts = np.cumsum([0] + [len(clause) for clause in query])[:-1]
+        weights = np.array([1 if self.idf is None else self.idf[class_id] for class_id in classes], np.float32)
+        counts = [self.index.count(class_id) for class_id in classes]
+
+        # weighted scores of seen images in each class of the query and whether they were read, rows of images
+        # are found by image id, the arrays grow by doubling
+        seen = np.zeros(0, np.uint32)
+        rows = np.zeros(0, np.int64)
+        known = np.zeros([len(classes), 0], np.float32)
+        read = np.zeros([len(classes), 0], np.bool_)
+        lower = np.zeros(0, np.float32)
+        # images that can still be among the best, their upper bounds only decrease and lower bounds only increase
+        alive = np.zeros(0, np.bool_)
+        depth, step = 0, max(block_size, top_k)
+
+        while True:
+            postings = [self.index.postings(class_id, depth, depth + step) for class_id in classes]
+            depth += step
+            step *= 2
+
+            read_ids = np.concatenate([p['id'] for p in postings] + [np.zeros(0, np.uint32)])
+            if len(read_ids) > 0 and np.amax(read_ids) >= len(rows):
+                rows = np.concatenate([rows, np.full(int(np.amax(read_ids)) + 1 - len(rows), -1, np.int64)])
+
+            # the last occurrence of each id that was not seen yet keeps its position
+            new_ids = read_ids[rows[read_ids] < 0]
+            rows[new_ids] = np.arange(len(new_ids))
+            new_ids = new_ids[rows[new_ids] == np.arange(len(new_ids))]
+            rows[new_ids] = np.arange(len(seen), len(seen) + len(new_ids))
+            seen = np.concatenate([seen, new_ids])
+            if len(seen) > len(lower):
+                known = np.concatenate([known, np.zeros([len(classes), len(seen)], np.float32)], axis=1)
+                read = np.concatenate([read, np.zeros([len(classes), len(seen)], np.bool_)], axis=1)
+                lower = np.concatenate([lower, np.full(len(seen), -1, np.float32)])
+                alive = np.concatenate([alive, np.ones(len(seen), np.bool_)])
+
+            for i, p in enumerate(postings):
+                known[i, rows[p['id']]] = p['score'] * weights[i]
+                read[i, rows[p['id']]] = True
+
+            # lower bounds change only for the images read in this step, images not read in all clauses yet
+            # are below images with zero score
+            changed = np.zeros(len(seen), np.bool_)
+            changed[rows[read_ids]] = True
+            changed = np.flatnonzero(changed & alive[:len(seen)])
+            present = np.logical_or.reduceat(read[:, changed], clause_starts, axis=0).all(axis=0)
+            lower[changed] = np.where(present, KeywordModel._combine_clauses(known[:, changed], clause_starts), -1)
+
+            bounds = np.array([self.index.score_bound(class_id, depth) * w if depth < count else 0
+                               for class_id, w, count in zip(classes, weights, counts)], np.float32)
+            threshold = KeywordModel._combine_clauses(bounds[:, np.newaxis], clause_starts)[0]
+
+            best = np.argpartition(-lower[:len(seen)], top_k - 1)[:top_k] if top_k < len(seen) \
+                else np.arange(len(seen))
+            kth_lower = np.amin(lower[best]) if len(best) == top_k else np.float32(-1)
+            if not np.any(bounds > 0):
+                break
+            if kth_lower < threshold:
+                continue
+
+            alive[best] = False
+            others = np.flatnonzero(alive[:len(seen)])
+            alive[best] = True
+            upper = KeywordModel._combine_clauses(
+                np.where(read[:, others], known[:, others], bounds[:, np.newaxis]), clause_starts)
+            if kth_lower >= np.amax(upper, initial=0):
+                break
+            alive[others[upper < kth_lower]] = False
+
+        # random access only to the classes of unknown scores of the best images
+        ids, known, read = seen[best], known[:, best], read[:, best]
+        for i, (class_id, w) in enumerate(zip(classes, weights)):
+            if bounds[i] > 0 and not np.all(read[i]):
+                class_ids, class_scores = self._get_lookup(class_id)
+                if len(class_ids) > 0:
+                    positions = np.minimum(np.searchsorted(class_ids, ids), len(class_ids) - 1)
+                    hit = ~read[i] & (class_ids[positions] == ids)
+                    known[i, hit] = class_scores[positions[hit]] * w
+                    read[i, hit] = True
+
+        # images are ranked only if present in all clauses
+        present = np.logical_or.reduceat(read, clause_starts, axis=0).all(axis=0)
+        scores = KeywordModel._combine_clauses(known, clause_starts)
+        return KeywordModel._top_k(ids[present], scores[present], top_k)
+
+    @staticmethod
+    def _combine_clauses(scores, clause_starts):
+        """
+        Args:
+            scores: Matrix of weighted scores [classes of the query, images], classes of a clause are consecutive.
+            clause_starts: Numpy array of the first row of each clause.
+
+        Returns:
+            Numpy array of image scores, sums of clauses are multiplied with the same precision as in `rank`.
+        """
+        clause_stops = list(clause_starts[1:]) + [len(scores)]
+        result = np.ones(scores.shape[1], np.float32)
+        for start, stop in zip(clause_starts, clause_stops):
+            clause = scores[start].astype(np.float64)
+            for i in range(start + 1, stop):
+                clause += scores[i]
+            result *= clause.astype(np.float32)
+        return result
+
+    def _get_lookup(self, class_id):
+        """
+        Returns:
+            Tuple of numpy arrays of image ids of a class sorted ascending and their scores for random access.
+        """
+        if class_id in self._lookup_cache:
+            self._lookup_cache.move_to_end(class_id)
+            return self._lookup_cache[class_id]
+
+        postings = self.index.postings(class_id)
+        order = np.argsort(postings['id'])
+        lookup = postings['id'][order], postings['score'][order]
+
+        if len(self._lookup_cache) == KeywordModel.MAX_CACHE_SIZE:
+            self._lookup_cache.popitem(last=False)
+        self._lookup_cache[class_id] = lookup
+        return lookup
+
+    def _get_scores(self, query):
+        """
+        Returns:
+            Tuple of numpy arrays of unique image ids sorted ascending and their scores.
+        """
+        if len(query) == 0:
+            return np.zeros(0, np.uint32), np.zeros(0, np.float32)
+
+        ids, scores = self._resolve_clause(query[0])
+        for clause in query[1:]:
+            if len(ids) == 0:
+                break
+            clause_ids, clause_scores = self._resolve_clause(clause)
+            ids, indexes, clause_indexes = np.intersect1d(ids, clause_ids, assume_unique=True, return_indices=True)
+            scores = scores[indexes] * clause_scores[clause_indexes]
+        return ids, scores
+
+    def _resolve_clause(self, clause):
+        """
+        Returns:
+            Tuple of numpy arrays of unique image ids sorted ascending and sum of their scores across the clause.
+        """
+        postings = [self.index.postings(class_id) for class_id in clause]
+        weights = [1 if self.idf is None else self.idf[class_id] for class_id in clause]
+
+        ids = np.concatenate([p['id'] for p in postings])
+        scores = np.concatenate([p['score'] * np.float32(w) for p, w in zip(postings, weights)])
+
+        if len(clause) == 1:
+            order = np.argsort(ids)
+            return ids[order], scores[order]
+
+        ids, inverse = np.unique(ids, return_inverse=True)
+        return ids, np.bincount(inverse.ravel(), weights=scores, minlength=len(ids)).astype(np.float32)
+
+    @staticmethod
+    def _top_k(ids, scores, top_k):
+        """
+        Returns:
+            Tuple of numpy arrays of at most `top_k` image ids and their scores sorted by descending score.
+        """
+        if top_k is not None and top_k < len(scores):
+            best = np.argpartition(-scores, top_k - 1)[:top_k] if top_k > 0 else np.zeros(0, np.int64)
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return ids[best], scores[best]
@@ -0,0 +1,145 @@
+import os
+import numpy as np
+
+from common_utils import dataset
+from common_utils.inverted_index import InvertedIndex, POSTING
+
+MANIFEST_MAGIC = 'KS SEGMENTS'
+
+
+def is_manifest(filename):
+    """
+    Returns:
+        True if the file is a manifest of a segmented index created by `processing/update_index.py`.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC.encode('ascii')
+
+
+def read_manifest(filename):
+    """Reads manifest of a segmented index.
+
+    The manifest is a text file, the first line contains `MANIFEST_MAGIC` and the number of the next segment,
+    each following line contains a segment filename relative to the manifest and the first and the last
+    image id of the segment. Segments are ordered from the oldest.
+
+    Args:
+        filename: Location of the manifest.
+
+    Returns:
+        Tuple.
+        Number of the next segment.
+        List of tuples (segment filename, first image id, last image id).
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        magic, next_segment = f.readline().rsplit(' ', 1)
+        if magic != MANIFEST_MAGIC:
+            raise Exception("Invalid manifest file format.")
+
+        segments = []
+        for line in f:
+            segment, first_id, last_id = line.split()
+            segments.append((segment, int(first_id), int(last_id)))
+    return int(next_segment), segments
+
+
+def write_manifest(filename, next_segment, segments):
+    """Replaces manifest of a segmented index atomically, readers see either the old or the new manifest.
+
+    Args:
+        filename: Location of the manifest.
+        next_segment: Number of the next segment.
+        segments: List of tuples (segment filename, first image id, last image id).
+    """
+    with dataset.create_file_atomically(filename, [], []) as f:
+        f.write('{} {:d}\n'.format(MANIFEST_MAGIC, next_segment).encode('utf-8'))
+        for segment, first_id, last_id in segments:
+            f.write('{} {:d} {:d}\n'.format(segment, first_id, last_id).encode('utf-8'))
+
+
+class SegmentedIndex:
+    """
+    A class reading inverted index split into segments of disjoint image ids, e.g. a base index and
+    indexes of newly added videos. It can be used in place of `InvertedIndex`, postings of a class
+    from all segments are merged and sorted by descending score.
+    """
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename: Location of the manifest.
+        """
+        directory = os.path.dirname(filename)
+        _, segments = read_manifest(filename)
+
+        # segments are opened at once, so later changes of the manifest do not affect the reader
+        self.segments = [InvertedIndex(os.path.join(directory, segment)) for segment, _, _ in segments]
+        self._classes = sorted(set(class_id for segment in self.segments for class_id in segment.classes))
+
+    def __len__(self):
+        return len(self._classes)
+
+    def __contains__(self, class_id):
+        return any(class_id in segment for segment in self.segments)
+
+    def __getitem__(self, class_id):
+        return self.postings(class_id)
+
+    @property
+    def classes(self):
+        """
+        Returns:
+            List of class ids in the index.
+        """
+        return list(self._classes)
+
+    def count(self, class_id):
+        """
+        Args:
+            class_id: Class id as in the label file.
+
+        Returns:
+            Number of images in the class.
+        """
+        return sum(segment.count(class_id) for segment in self.segments)
+
+    def postings(self, class_id, start=0, stop=None):
+        """
+        Args:
+            class_id: Class id as in the label file.
+            start: Position of the first posting to return.
+            stop: Position after the last posting to return, all postings till the end if None.
+
+        Returns:
+            Array of `POSTING` (image id, score) sorted by descending score.
+        """
+        if len(self.segments) == 1 and self.segments[0].version == 1:
+            return self.segments[0].postings(class_id, start, stop)
+
+        postings = []
+        for segment in self.segments:
+            if stop is None:
+                postings.append(segment.postings(class_id))
+            elif segment.version == 1:
+                postings.append(segment.postings(class_id, 0, stop))
+            else:
+                # blocks are sorted by descending score, the best postings are in the first blocks
+                postings.append(segment.postings(class_id, 0, -(-stop // segment.block_size) * segment.block_size))
+
+        postings = np.concatenate(postings + [np.zeros(0, dtype=POSTING)])
+        postings = postings[np.argsort(-postings['score'], kind='stable')]
+        return postings[start:stop]
+
+    def score_bound(self, class_id, position):
+        """
+        Args:
+            class_id: Class id as in the label file.
+            position: Position of a posting.
+
+        Returns:
+            Upper bound of scores of the postings from the position till the end of the class.
+        """
+        postings = self.postings(class_id, position, position + 1)
+        if len(postings) == 0:
+            return np.float32(0)
+        return postings['score'][0]
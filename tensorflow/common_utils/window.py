@@ -0,0 +1,90 @@
+import numpy as np
+
+
+def sparse_table(array, max_length):
+    """Precomputes maxima of ranges of power of two lengths by doubling.
+
+    Args:
+        array: Numpy array, ranges are taken along the last axis, e.g. a matrix of score vectors.
+        max_length: The longest range that will be queried.
+
+    Returns:
+        List of arrays of the shape of `array`, k-th array holds maxima of `array[..., i:i + 2 ** k]`,
+        ranges are cut at the end of the array.
+    """
+    table = [np.asarray(array)]
+    length = 1
+    while 2 * length <= max_length:
+        previous = table[-1]
+        level = previous.copy()
+        level[..., :-length] = np.maximum(previous[..., :-length], previous[..., length:])
+        table.append(level)
+        length *= 2
+    return table
+
+
+def range_max(table, starts, stops):
+    """Computes maxima of ranges in O(1) per range by two overlapping ranges of power of two length.
+
+    Args:
+        table: Sparse table created by `sparse_table`.
+        starts: Numpy array of the first positions of the ranges.
+        stops: Numpy array of the positions after the last positions of the ranges, each range must be
+            non-empty and not longer than `max_length` of the table.
+
+    Returns:
+        Array of maxima of the ranges along the last axis, one for each range.
+    """
+    starts, stops = np.asarray(starts, dtype=np.int64), np.asarray(stops, dtype=np.int64)
+    levels = np.searchsorted(2 ** np.arange(len(table)), stops - starts, side='right') - 1
+
+    result = np.empty(table[0].shape[:-1] + starts.shape, dtype=table[0].dtype)
+    for level in np.unique(levels):
+        mask = levels == level
+        result[..., mask] = np.maximum(table[level][..., starts[mask]],
+                                       table[level][..., stops[mask] - 2 ** level])
+    return result
+
+
+def get_video_ends(video_starts, positions):
+    """
+    Args:
+        video_starts: Sorted numpy array of the first image of every video.
+        positions: Numpy array of images.
+
+    Returns:
+        Numpy array of the position after the last image of the video of each image,
+        images after the start of the last video are in one video.
+    """
+    ends = np.append(np.asarray(video_starts, dtype=np.int64), np.iinfo(np.int64).max)
+    return ends[np.searchsorted(video_starts, positions, side='right')]
+
+
+def sliding_window_max(array, window, video_starts=None):
+    """Computes maximum of every `window` consecutive values starting at each position,
+    windows are cut at the end of the array and, if given, at the end of a video.
+
+    Args:
+        array: Numpy vector of scores or a matrix of score vectors, windows are taken along the last axis.
+        window: Number of values in a window.
+        video_starts: Sorted numpy array of the first image of every video or None.
+
+    Returns:
+        Array of the shape of `array`, the value at position i is maximum of `array[..., i:i + window]`.
+    """
+    table = sparse_table(array, window)
+    length = np.shape(array)[-1]
+
+    # windows of full length by slices, the table cuts them at the end of the array
+    shift = window - 2 ** (len(table) - 1)
+    count = max(length - shift, 0)
+    result = table[-1].copy()
+    result[..., :count] = np.maximum(table[-1][..., :count], table[-1][..., shift:shift + count])
+
+    # only windows starting less than `window` images before a video start can be cut
+    if video_starts is not None:
+        starts = np.unique((np.asarray(video_starts, dtype=np.int64)[:, np.newaxis] - np.arange(1, window)).ravel())
+        starts = starts[(starts >= 0) & (starts < length)]
+        stops = np.minimum(np.minimum(starts + window, length), get_video_ends(video_starts, starts))
+        result[..., starts] = range_max(table, starts, stops)
+    return result
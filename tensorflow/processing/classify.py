@@ -1,17 +1,34 @@
 import argparse
 import os
-import struct
+import time
+import pickle
 import numpy as np
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 import tensorflow as tf
 
 from models import network
+from processing import merge_shards
 from common_utils import console, dataset, input_pipeline
 from common_utils.dataset import DEFAULT_HEADER
 HEADER = DEFAULT_HEADER
 
 
-def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc_cov=True):
+def get_file_ids(filenames, keys):
+    """
+    Args:
+        filenames: Images to classify as given to `run`.
+        keys: Image filenames as byte strings.
+
+    Returns:
+        Numpy array of image ids.
+    """
+    if isinstance(filenames, dict):
+        return np.array([filenames[key.decode("utf-8")] for key in keys], dtype=np.uint32)
+    return np.array([int(os.path.split(key)[1][:-4]) for key in keys], dtype=np.uint32)
+
+
+def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc_cov=True, resume=False,
+        checkpoint_interval=600):
     """Classifies given images and creates deep-feature and softmax output raw files.
 
     Args:
@@ -22,11 +39,31 @@ def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc
         prob_threshold: Threshold :math:`\\mu`. Labels with probability smaller than :math:`\\mu` will not be saved.
         calc_cov: Calculate :math:`\\mathbb{E}\\left[XY\\right]` and :math:`\\mathbb{E}\\left[X\\right]`
             needed for covariance matrix.
+        resume: If true, classification continues from `run_name`.checkpoint file, already classified images
+            are skipped and the output files are appended.
+        checkpoint_interval: Number of seconds between checkpoints.
     """
     pt = console.ProgressTracker()
+
+    checkpoint = None
+    if resume:
+        if not os.path.isfile(run_name + '.checkpoint'):
+            raise Exception("Checkpoint " + run_name + ".checkpoint does not exist.")
+        with open(run_name + '.checkpoint', 'rb') as f:
+            checkpoint = pickle.load(f)
+
+        classified = set(checkpoint['processed_ids'].tolist())
+        if isinstance(filenames, dict):
+            filenames = {k: v for k, v in filenames.items() if v not in classified}
+        else:
+            filenames = [f for f in filenames if int(os.path.split(f)[1][:-4]) not in classified]
+        pt.info(">> Resuming classification, {:d} images already classified.".format(len(classified)))
+        if len(filenames) == 0:
+            pt.info("\t> Nothing to classify, only the output files are finalized.")
+
     pt.info(">> Initializing TensorFlow model...")
 
-    keys, images = input_pipeline.make_batch_from_jpeg(filenames)
+    keys, images = input_pipeline.make_dataset_from_jpeg(filenames)
 
     session = tf.Session()
     session.run(tf.local_variables_initializer())
@@ -64,8 +101,9 @@ def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc
         cum_XY = tf.get_variable("Cumulative_XY", shape=[num_classes, num_classes], dtype=tf.float32,
                                  initializer=tf.zeros_initializer)
 
-        add_cum_X = tf.add(cum_X, tf.reduce_sum(probabilities, 0), name="UpdateAdd_X")
-        add_cum_XY = tf.add(cum_XY, tf.matmul(tf.transpose(probabilities), probabilities), name="UpdateAdd_XY")
+        add_cum_X = tf.assign_add(cum_X, tf.reduce_sum(probabilities, 0), name="UpdateAdd_X")
+        add_cum_XY = tf.assign_add(cum_XY, tf.matmul(tf.transpose(probabilities), probabilities),
+                                   name="UpdateAdd_XY")
 
     session.run(tf.global_variables_initializer())
 
@@ -75,24 +113,40 @@ def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc
         saver = tf.train.Saver()
     saver.restore(session, model_path)
 
-    annot_f = dataset.create_file(
-        run_name + '.annotation',
-        [('<I', num_classes)],
-        HEADER
-    )
-    dpfea_f = dataset.create_file(
-        run_name + '.deep-features',
-        [('<I', df_shape)],
-        HEADER
-    )
-    softm_f = dataset.create_file(
-        run_name + '.softmax',
-        [('<I', num_classes)],
-        HEADER
-    )
+    if checkpoint is None:
+        annot_f = dataset.create_file(
+            run_name + '.annotation',
+            [('<I', num_classes)],
+            HEADER
+        )
+        dpfea_f = dataset.create_file(
+            run_name + '.deep-features',
+            [('<I', df_shape)],
+            HEADER
+        )
+        softm_f = dataset.create_file(
+            run_name + '.softmax',
+            [('<I', num_classes)],
+            HEADER
+        )
+        processed_ids = [np.zeros(0, dtype=np.uint32)]
+        r_cum_X = np.zeros([num_classes], dtype=np.float32)
+        r_cum_XY = np.zeros([num_classes, num_classes], dtype=np.float32)
+    else:
+        # images classified after the last checkpoint are dropped
+        annot_f, dpfea_f, softm_f = [
+            _open_for_append(run_name + extension, offset)
+            for extension, offset in zip(['.annotation', '.deep-features', '.softmax'], checkpoint['offsets'])
+        ]
+        processed_ids = [checkpoint['processed_ids']]
+        r_cum_X, r_cum_XY = checkpoint['sum_X'], checkpoint['sum_XY']
+        if calc_cov:
+            cum_X.load(r_cum_X, session)
+            cum_XY.load(r_cum_XY, session)
 
     pt.info(">> Classifying...")
     pt.reset(len(filenames))
+    last_checkpoint = time.time()
 
     try:
         while not coord.should_stop():
@@ -103,49 +157,32 @@ def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc
             else:
                 r_keys, r_prob, r_dp_ftr = session.run([keys, probabilities, deep_features])
 
-            for i in range(len(r_keys)):
-                _, filename = os.path.split(r_keys[i])
-
-                if isinstance(filenames, dict):
-                    file_id = filenames[r_keys[i].decode("utf-8")]
-                else:
-                    file_id = int(filename[:-4])
-
-                r_top_indexes = np.where(r_prob[i] >= prob_threshold)[0]
-                m_len = len(r_top_indexes)
-                r_top_vals = np.zeros(m_len)
-
-                for b in range(m_len):
-                    r_top_vals[b] = r_prob[i][r_top_indexes[b]]
-
-                annot_f.write(struct.pack('<I', file_id))
-
-                annot_f.write(struct.pack('<I', m_len))
-                annot_f.write(struct.pack('<' + 'I' * m_len, *r_top_indexes) +
-                              struct.pack('<' + 'f' * m_len, *r_top_vals))
+            file_ids = get_file_ids(filenames, r_keys)
 
-                dpfea_f.write(struct.pack('<I', file_id))
-                dpfea_f.write(struct.pack('<' + 'f' * df_shape, *r_dp_ftr[i]))
+            dataset.write_annotations(annot_f, file_ids, r_prob, prob_threshold)
+            dataset.write_records(dpfea_f, file_ids, r_dp_ftr)
+            dataset.write_records(softm_f, file_ids, r_prob)
+            processed_ids.append(file_ids)
 
-                softm_f.write(struct.pack('<I', file_id))
-                softm_f.write(struct.pack('<' + 'f' * num_classes, *r_prob[i]))
+            if time.time() - last_checkpoint > checkpoint_interval:
+                _save_checkpoint(run_name + '.checkpoint', [annot_f, dpfea_f, softm_f], processed_ids,
+                                 r_cum_X, r_cum_XY)
+                last_checkpoint = time.time()
 
             pt.increment(len(r_keys))
     except tf.errors.OutOfRangeError:
+        _save_checkpoint(run_name + '.checkpoint', [annot_f, dpfea_f, softm_f], processed_ids, r_cum_X, r_cum_XY)
         pt.info(">> Classification completed.")
     finally:
         if calc_cov:
-            frmt = '<' + 'f' * len(r_cum_X)
-
             # save sum of X
             cum_X_f = dataset.create_file(run_name + '.sumX', [('<I', len(r_cum_X))], HEADER)
-            cum_X_f.write(struct.pack(frmt, *r_cum_X))
+            r_cum_X.astype('<f4').tofile(cum_X_f)
             cum_X_f.close()
 
             # save sum of XY
             cum_XY_f = dataset.create_file(run_name + '.sumXY', [('<I', len(r_cum_XY))], HEADER)
-            for i in range(len(r_cum_XY)):
-                cum_XY_f.write(struct.pack(frmt, *r_cum_XY[i]))
+            r_cum_XY.astype('<f4').tofile(cum_XY_f)
             cum_XY_f.close()
 
         annot_f.close()
@@ -160,6 +197,48 @@ def run(filenames, num_classes, model_path, run_name, prob_threshold=0.001, calc
         session.close()
 
 
+def _save_checkpoint(filename, files, processed_ids, sum_X, sum_XY):
+    """Saves state of classification after all data of the processed images are written to disk.
+
+    Args:
+        filename: Location of the checkpoint file.
+        files: List of the output files.
+        processed_ids: List of numpy arrays of ids of the images written to the files, the arrays are
+            concatenated in place.
+        sum_X: Sum of softmax values of the processed images.
+        sum_XY: Sum of outer products of softmax values of the processed images.
+    """
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+
+    processed_ids[:] = [np.concatenate(processed_ids)]
+    checkpoint = {
+        'offsets': [f.tell() for f in files],
+        'processed_ids': processed_ids[0],
+        'sum_X': sum_X,
+        'sum_XY': sum_XY
+    }
+
+    # the previous checkpoint stays valid if interrupted
+    with dataset.create_file_atomically(filename, [], []) as f:
+        pickle.dump(checkpoint, f)
+
+
+def _open_for_append(filename, offset):
+    """Opens an output file of a previous run and removes data written after the offset.
+
+    Returns:
+        Handle of the file positioned at the offset.
+    """
+    dataset.read_file(filename, HEADER).close()
+
+    file = open(filename, 'r+b')
+    file.truncate(offset)
+    file.seek(offset)
+    return file
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--image_dir', required=True, help='directory where to find images for classification')
@@ -168,9 +247,32 @@ if __name__ == '__main__':
     parser.add_argument('--run_name', required=True)
     parser.add_argument('--prob_threshold', type=float, default=0.001)
     parser.add_argument('--calc_cov', action='store_true', default=False)
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue classification from the last checkpoint of the run')
+    parser.add_argument('--checkpoint_interval', type=int, default=600, help='number of seconds between checkpoints')
+    parser.add_argument('--first_id', type=int, default=0,
+                        help='id of the first image, use the next id of an existing index to classify new videos only')
+    parser.add_argument('--shard', default=None,
+                        help='classify only i-th of n contiguous ranges of image ids given as i/n into separate files, '
+                             'merge the files by processing/merge_shards.py')
+    parser.add_argument('--manifest', default=None,
+                        help='read images and their ids from a frame manifest of processing/scan_images.py '
+                             'instead of listing the image directory')
+    parser.add_argument('--new_only', action='store_true', default=False,
+                        help='classify only images that were new or changed in the last scan of the manifest')
     args = parser.parse_args()
 
-    images = dataset.get_images_from_disk(args.image_dir)
+    if args.manifest:
+        images = dataset.get_images_from_manifest(args.image_dir, args.manifest, args.new_only)
+    else:
+        images = dataset.get_images_from_disk(args.image_dir, args.first_id)
+    run_name = args.run_name
+
+    if args.shard:
+        shard, no_shards = merge_shards.parse_shard(args.shard)
+        images = merge_shards.select_shard(images, shard, no_shards)
+        run_name = merge_shards.get_shard_run_name(run_name, shard, no_shards)
 
-    run(images, args.num_classes, model_path=args.model_path, run_name=args.run_name,
-        prob_threshold=args.prob_threshold, calc_cov=args.calc_cov)
+    run(images, args.num_classes, model_path=args.model_path, run_name=run_name,
+        prob_threshold=args.prob_threshold, calc_cov=args.calc_cov, resume=args.resume,
+        checkpoint_interval=args.checkpoint_interval)
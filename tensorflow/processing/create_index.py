@@ -1,119 +1,377 @@
-import struct
+import os
+import shutil
 import argparse
+import tempfile
 import numpy as np
 
 from common_utils import dataset, console
 from common_utils.dataset import DEFAULT_HEADER
+from common_utils.inverted_index import INDEX_MAGIC, INDEX_MAGIC_V2, POSTING, SEPARATOR, HEADER_V2, CLASS_V2, BLOCK_V2
 HEADER = DEFAULT_HEADER
 
+BUCKET_RECORD = np.dtype([('class', '<u4'), ('id', '<u4'), ('score', '<f4')])
+# bucket record and sort permutation with temporaries
+BYTES_PER_POSTING = 32
 
-def create_index_file(pseudo_index_filename, index_filename):
+
+def create_index_file(pseudo_index_filename, index_filename, chunk_size=64 * 1024 * 1024, version=1,
+                      block_size=512, score_bytes=1):
     """Takes annotation file generated by classification script and created inverted index.
 
     Args:
         pseudo_index_filename: Annotation file generated by classification script.
         index_filename: Path and name of the resulting inverted index file.
+        chunk_size: Number of bytes of the annotation file to read at once.
+        version: Version of the index file format, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
     """
-    classes = get_class_representatives(pseudo_index_filename)
+    no_classes, image_ids, class_ids, values = get_class_representatives(pseudo_index_filename, chunk_size)
 
     pt = console.ProgressTracker()
-    pt.info(">> Creating inverted index...")
-    pt.reset(len(classes))
+    pt.info(">> Grouping images by class...")
 
-    file = open(index_filename, "wb")
+    counts = np.bincount(class_ids, minlength=no_classes)
+    write_index_file(index_filename, counts, _sorted_postings(image_ids, class_ids, values, 0, no_classes),
+                     version, block_size, score_bytes)
 
-    file.write(b'KS INDEX')
-    file.write(b'\xff\xff\xff\xff\xff\xff\xff\xff')
 
-    offset = len(classes) * 8 + 16 + 8
-    sorted_classes = sorted(classes)
+def create_index_file_external(pseudo_index_filename, index_filename, max_memory, chunk_size=64 * 1024 * 1024,
+                               tmp_dir=None, version=1, block_size=512, score_bytes=1):
+    """Takes annotation file generated by classification script and created inverted index
+    using bounded amount of memory.
 
-    # class-to-offset map
-    for key in sorted_classes:
-        file.write(struct.pack("I", key) + struct.pack("I", offset))
-        offset += classes[key]["len"] * 8 + 8
-    file.write(b'\xff\xff\xff\xff\xff\xff\xff\xff')
-
-    # actual (image id, rank) pairs
-    for key in sorted_classes:
-        photos = list(zip(classes[key]["img_ids"], classes[key]["values"]))
-        photos.sort(key=lambda tup: -tup[1])
-        for photo_id, photo_val in photos:
-            file.write(struct.pack("I", photo_id) + struct.pack("f", photo_val))
-        file.write(b'\xff\xff\xff\xff\xff\xff\xff\xff')
-        pt.increment()
-
-    file.close()
-    pt.info(">> Inverted index created.")
+    Image classes are partitioned into buckets of consecutive classes that fit into memory,
+    each bucket is spilled to disk, sorted independently and appended to the index.
 
+    Args:
+        pseudo_index_filename: Annotation file generated by classification script.
+        index_filename: Path and name of the resulting inverted index file.
+        max_memory: Approximate maximal number of bytes to use.
+        chunk_size: Number of bytes of the annotation file to read at once.
+        tmp_dir: Directory for temporary bucket files, directory of the index file is used if None.
+        version: Version of the index file format, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
+    """
+    pt = console.ProgressTracker()
+    chunk_size = min(chunk_size, max_memory // 4)
+
+    pt.info(">> Counting images of each class...")
+    no_classes, chunks = dataset.read_annotations(pseudo_index_filename, chunk_size)
+    counts = np.zeros(no_classes, dtype=np.int64)
+    for _, class_ids, _ in chunks:
+        counts += np.bincount(class_ids, minlength=no_classes)
+
+    bucket_starts = _partition_classes(counts, max(1, max_memory // BYTES_PER_POSTING))
+    bucket_of_class = np.repeat(np.arange(len(bucket_starts)), np.diff(np.append(bucket_starts, no_classes)))
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(index_filename))
+    tmp_dir = tempfile.mkdtemp(prefix="index-buckets-", dir=tmp_dir)
+    bucket_filenames = [os.path.join(tmp_dir, "{:d}.bucket".format(i)) for i in range(len(bucket_starts))]
+
+    try:
+        pt.info(">> Spilling image classes to {:d} buckets...".format(len(bucket_starts)))
+        _, chunks = dataset.read_annotations(pseudo_index_filename, chunk_size)
+
+        for image_ids, class_ids, values in chunks:
+            buckets = bucket_of_class[class_ids]
+            order = np.argsort(buckets, kind='stable')
+
+            records = np.empty(len(order), dtype=BUCKET_RECORD)
+            records['class'] = class_ids[order]
+            records['id'] = image_ids[order]
+            records['score'] = values[order]
+
+            start = 0
+            for bucket, count in enumerate(np.bincount(buckets, minlength=len(bucket_starts))):
+                if count > 0:
+                    with open(bucket_filenames[bucket], "ab") as f:
+                        records[start:start + count].tofile(f)
+                start += count
+
+        def postings():
+            for bucket, first_class in enumerate(bucket_starts):
+                last_class = bucket_starts[bucket + 1] if bucket + 1 < len(bucket_starts) else no_classes
+
+                if os.path.isfile(bucket_filenames[bucket]):
+                    records = np.fromfile(bucket_filenames[bucket], dtype=BUCKET_RECORD)
+                    os.remove(bucket_filenames[bucket])
+                else:
+                    records = np.zeros(0, dtype=BUCKET_RECORD)
+
+                yield from _sorted_postings(records['id'], records['class'], records['score'],
+                                            first_class, last_class - first_class)
+
+        write_index_file(index_filename, counts, postings(), version, block_size, score_bytes)
+    finally:
+        shutil.rmtree(tmp_dir)
 
-def get_class_representatives(filename, max_images_per_class=2000000):
-    """Loads content of annotation file to memory.
+
+def _partition_classes(counts, max_postings):
+    """Splits classes into buckets of consecutive classes with at most `max_postings` postings.
+    A class with more postings than `max_postings` forms its own bucket.
 
     Args:
-        filename: A file to read.
-        max_images_per_class: Maximum of images per class (for preallocation of memory).
+        counts: Number of images of each class.
+        max_postings: Maximal number of postings in a bucket.
 
     Returns:
-        Dictionary of (class id, class representatives).
+        Numpy array of the first class of each bucket.
+    """
+    # the first bucket starts at class 0 even if the leading classes have no postings
+    starts = [0]
+    size = 0
+    for cls, count in enumerate(counts):
+        if cls > 0 and size + count > max_postings:
+            starts.append(cls)
+            size = 0
+        size += count
+    return np.array(starts, dtype=np.int64)
+
+
+def _sorted_postings(image_ids, class_ids, values, first_class, no_classes):
+    """Groups postings by class and sorts them by descending score.
+
+    Args:
+        image_ids: Numpy array of image ids.
+        class_ids: Numpy array of class ids, all from `first_class` to `first_class + no_classes - 1`.
+        values: Numpy array of values.
+        first_class: The smallest class id.
+        no_classes: Number of classes.
+
+    Yields:
+        Arrays of `POSTING` for each class in order.
+    """
+    # stable sort keeps the order of the annotation file for images with the same value
+    order = np.argsort(class_ids, kind='stable')
+    counts = np.bincount(class_ids, minlength=first_class + no_classes)[first_class:]
+
+    start = 0
+    for count in counts:
+        indexes = order[start:start + count]
+        indexes = indexes[np.argsort(-values[indexes], kind='stable')]
+
+        photos = np.empty(len(indexes), dtype=POSTING)
+        photos['id'] = image_ids[indexes]
+        photos['score'] = values[indexes]
+
+        start += count
+        yield photos
+
+
+def write_index_file(index_filename, counts, class_postings, version=1, block_size=512, score_bytes=1):
+    """Writes inverted index file.
+
+    Args:
+        index_filename: Path and name of the resulting inverted index file.
+        counts: Number of images of each class, classes are numbered from 0.
+        class_postings: Iterable of arrays of `POSTING` sorted by descending score, one for each class in order.
+        version: Version of the index file format, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
+    """
+    if version == 2:
+        _write_index_file_v2(index_filename, counts, class_postings, block_size, score_bytes)
+        return
+
+    pt = console.ProgressTracker()
+    pt.info(">> Creating inverted index...")
+    pt.reset(len(counts))
+
+    counts = np.asarray(counts, dtype=np.int64)
+
+    # class-to-offset map
+    table = np.empty(len(counts), dtype=[('class', '<u4'), ('offset', '<u4')])
+    offsets = len(counts) * 8 + 16 + 8 + np.cumsum(counts * 8 + 8) - (counts * 8 + 8)
+    if len(offsets) > 0 and offsets[-1] + counts[-1] * 8 + 8 > 2 ** 32:
+        raise Exception("Inverted index is too large for 32 bit offsets.")
+    table['class'] = np.arange(len(counts))
+    table['offset'] = offsets
+
+    with open(index_filename, "wb") as file:
+        file.write(INDEX_MAGIC)
+        file.write(SEPARATOR)
+        table.tofile(file)
+        file.write(SEPARATOR)
+
+        # actual (image id, rank) pairs
+        no_written = 0
+        for count, photos in zip(counts, class_postings):
+            assert len(photos) == count, "Number of class postings does not match the class-to-offset map."
+            photos.tofile(file)
+            file.write(SEPARATOR)
+            no_written += 1
+            pt.increment()
+        assert no_written == len(counts), "Postings of some classes of the class-to-offset map are missing."
+
+    pt.info(">> Inverted index created.")
+
+
+def _write_index_file_v2(index_filename, counts, class_postings, block_size, score_bytes):
+    """Writes inverted index file in version 2 of the format.
+
+    Args:
+        index_filename: Path and name of the resulting inverted index file.
+        counts: Number of images of each class, classes are numbered from 0.
+        class_postings: Iterable of arrays of `POSTING` sorted by descending score, one for each class in order.
+        block_size: Number of postings in a block, must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2.
     """
-    classes = {}
+    assert block_size > 0 and block_size % 8 == 0, "Block size must be divisible by 8."
+    assert score_bytes in (1, 2), "Scores can be quantized only to 1 or 2 bytes."
+
     pt = console.ProgressTracker()
+    pt.info(">> Creating compressed inverted index...")
+    pt.reset(len(counts))
+
+    header = np.zeros(1, dtype=HEADER_V2)
+    header['block_size'] = block_size
+    header['score_bytes'] = score_bytes
+    header['no_classes'] = len(counts)
+    header['padding'] = 0xffffffff
+
+    table = np.zeros(len(counts), dtype=CLASS_V2)
+    table['class'] = np.arange(len(counts))
 
-    with dataset.read_file(filename, HEADER) as f:
-        raw_id = f.read(4)
-        no_classes = struct.unpack("<I", raw_id)[0]
-        raw_id = f.read(4)
-
-        dti = np.dtype(np.int32).newbyteorder("<")
-        dtf = np.dtype(np.float32).newbyteorder("<")
-
-        pt.info(">> Creating class representatives...")
-        pt.reset(no_classes)
-        for i in range(no_classes):
-            classes[i] = {
-                "len": 0,
-                "img_ids": np.zeros([max_images_per_class], np.int32),
-                "values": np.zeros([max_images_per_class], np.float32)
-            }
+    with open(index_filename, "wb") as file:
+        file.write(INDEX_MAGIC_V2)
+        header.tofile(file)
+        # table is written once all classes are known
+        table.tofile(file)
+
+        no_written = 0
+        for cls, (count, photos) in enumerate(zip(counts, class_postings)):
+            assert len(photos) == count, "Number of class postings does not match the number of images."
+            blocks, scores, scale, packed_ids = _compress_postings(photos, block_size, score_bytes)
+
+            table[cls] = (cls, count, scale, len(blocks), file.tell())
+            blocks.tofile(file)
+            scores.tofile(file)
+            file.write(b'\0' * (-scores.nbytes % 8))
+            packed_ids.tofile(file)
+            no_written += 1
             pt.increment()
+        assert no_written == len(counts), "Postings of some classes of the class table are missing."
+
+        file.seek(len(INDEX_MAGIC_V2) + HEADER_V2.itemsize)
+        table.tofile(file)
+
+    pt.info(">> Inverted index created.")
 
-        pt.info(">> Reading image classes...")
-        i = 0
-        while raw_id != b'':
-            i += 1
-            image_id = struct.unpack("<I", raw_id)[0]
-            no_indexes = struct.unpack("<I", f.read(4))[0]
 
-            image_indices = np.frombuffer(f.read(4 * no_indexes), dtype=dti)
-            image_values = np.frombuffer(f.read(4 * no_indexes), dtype=dtf)
-            if i % 10000 == 0:
-                pt.progress_info("\t> Images read: {}", [i])
+def _compress_postings(photos, block_size, score_bytes):
+    """Splits postings of a class into blocks, sorts each block by image id,
+    quantizes the scores and bit-packs differences of consecutive image ids.
 
-            raw_id = f.read(4)
+    Args:
+        photos: Array of `POSTING` sorted by descending score.
+        block_size: Number of postings in a block, must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2.
+
+    Returns:
+        Tuple.
+        Array of `BLOCK_V2` block descriptions.
+        Array of quantized scores.
+        Scale of the quantized scores.
+        Array of bytes of packed image id differences.
+    """
+    no_blocks = (len(photos) + block_size - 1) // block_size
+    padding = no_blocks * block_size - len(photos)
+
+    max_value = 2 ** (8 * score_bytes) - 1
+    scale = np.float32(photos['score'][0] / max_value) if len(photos) > 0 and photos['score'][0] > 0 else np.float32(1)
+    scores = np.clip(np.round(photos['score'] / scale), 0, max_value)
+
+    # sort each block by image id, padding is placed at the end of the last block
+    ids = np.append(photos['id'].astype(np.int64), np.full(padding, 2 ** 32, np.int64)).reshape([no_blocks, block_size])
+    scores = np.append(scores, np.zeros(padding)).reshape([no_blocks, block_size])
+
+    order = np.argsort(ids, axis=1, kind='stable')
+    ids = np.take_along_axis(ids, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    if padding > 0:
+        ids[-1, block_size - padding:] = ids[-1, block_size - padding - 1]
+
+    blocks = np.zeros(no_blocks, dtype=BLOCK_V2)
+    blocks['first_id'] = ids[:, 0]
+    blocks['max_score'] = np.amax(scores, axis=1).astype(np.float32) * scale
+
+    differences = np.diff(ids, axis=1, prepend=ids[:, :1])
+    blocks['bits'] = np.searchsorted(2 ** np.arange(33, dtype=np.int64), np.amax(differences, axis=1), side='right')
+
+    # the last block is stored without padding
+    lengths = (blocks['bits'].astype(np.int64) * block_size) // 8
+    if padding > 0:
+        lengths[-1] = (int(blocks['bits'][-1]) * (block_size - padding) + 7) // 8
+    blocks['ids_offset'] = np.cumsum(lengths) - lengths
+
+    packed_ids = np.zeros(np.sum(lengths), dtype=np.uint8)
+    for bits in np.unique(blocks['bits']).tolist():
+        if bits == 0:
+            continue
+        selected = np.flatnonzero(blocks['bits'] == bits)
+        unpacked = np.right_shift(differences[selected, :, np.newaxis], np.arange(bits - 1, -1, -1)) & 1
+        packed = np.packbits(unpacked.astype(np.uint8).reshape([len(selected), block_size * bits]), axis=1)
 
-            for j in range(no_indexes):
-                index = image_indices[j]
-                val = image_values[j]
+        positions = blocks['ids_offset'][selected].astype(np.int64)[:, np.newaxis] + np.arange(block_size * bits // 8)
+        valid = positions < (blocks['ids_offset'][selected] + lengths[selected])[:, np.newaxis]
+        packed_ids[positions[valid]] = packed[valid]
 
-                length = classes[index]["len"]
+    scores = scores.ravel()[:len(photos)]
+    return blocks, scores.astype('<u1' if score_bytes == 1 else '<u2'), scale, packed_ids
+
+
+def get_class_representatives(filename, chunk_size=64 * 1024 * 1024):
+    """Loads content of annotation file to memory.
+
+    Args:
+        filename: A file to read.
+        chunk_size: Number of bytes to read at once.
+
+    Returns:
+        Tuple.
+        Number of classes.
+        Numpy arrays of image ids, class ids and values of all (image, class) pairs in the file.
+    """
+    pt = console.ProgressTracker()
+    pt.info(">> Reading image classes...")
 
-                classes[index]["img_ids"][length] = image_id
-                classes[index]["values"][length] = val
+    no_classes, chunks = dataset.read_annotations(filename, chunk_size)
+    image_ids, class_ids, values = [], [], []
 
-                classes[index]["len"] += 1
+    for chunk_image_ids, chunk_class_ids, chunk_values in chunks:
+        image_ids.append(chunk_image_ids)
+        class_ids.append(chunk_class_ids)
+        values.append(chunk_values)
+        pt.progress_info("\t> Image classes read: {}", [sum(len(i) for i in image_ids)])
 
-        for i in range(no_classes):
-            l = classes[i]["len"]
-            classes[i]["img_ids"] = classes[i]["img_ids"][:l]
-            classes[i]["values"] = classes[i]["values"][:l]
-    return classes
+    if len(image_ids) == 0:
+        return no_classes, np.zeros(0, np.uint32), np.zeros(0, np.uint32), np.zeros(0, np.float32)
+    return no_classes, np.concatenate(image_ids), np.concatenate(class_ids), np.concatenate(values)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--pseudo_index_filename', help='location of pseudo-index file')
     parser.add_argument('--index_filename', help='name of the new index file')
+    parser.add_argument('--chunk_size', type=int, default=64, help='size of annotation file chunks in MB')
+    parser.add_argument('--max_memory_gb', type=float, default=None,
+                        help='spill image classes to disk to use at most given amount of memory')
+    parser.add_argument('--tmp_dir', default=None, help='directory for temporary files when spilling to disk')
+    parser.add_argument('--compressed', action='store_true', default=False,
+                        help='create version 2 of the index with compressed blocks of postings')
+    parser.add_argument('--block_size', type=int, default=512, help='number of postings in a compressed block')
+    parser.add_argument('--score_bytes', type=int, default=1, choices=[1, 2],
+                        help='number of bytes of a quantized score in the compressed index')
     args = parser.parse_args()
 
-    create_index_file(args.pseudo_index_filename, args.index_filename)
+    version = 2 if args.compressed else 1
+    if args.max_memory_gb is not None:
+        create_index_file_external(args.pseudo_index_filename, args.index_filename,
+                                   int(args.max_memory_gb * 1024 ** 3), args.chunk_size * 1024 * 1024, args.tmp_dir,
+                                   version, args.block_size, args.score_bytes)
+    else:
+        create_index_file(args.pseudo_index_filename, args.index_filename, args.chunk_size * 1024 * 1024,
+                          version, args.block_size, args.score_bytes)
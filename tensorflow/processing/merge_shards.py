@@ -0,0 +1,119 @@
+import os
+import struct
+import shutil
+import argparse
+import numpy as np
+
+from common_utils import console, dataset
+from common_utils.dataset import DEFAULT_HEADER
+HEADER = DEFAULT_HEADER
+
+
+def parse_shard(shard):
+    """
+    Args:
+        shard: Shard in format `i/n`, e.g. `0/4` for the first of four shards.
+
+    Returns:
+        Tuple of shard index and number of shards.
+    """
+    index, no_shards = [int(i) for i in shard.split('/')]
+    if not 0 <= index < no_shards:
+        raise Exception("Invalid shard " + shard + ".")
+    return index, no_shards
+
+
+def get_shard_run_name(run_name, index, no_shards):
+    """
+    Returns:
+        Path and name of the output files of the shard.
+    """
+    return "{}-shard{:d}of{:d}".format(run_name, index, no_shards)
+
+
+def select_shard(filenames, index, no_shards):
+    """Selects a contiguous range of image ids so that merged shards keep the order of the ids.
+
+    Args:
+        filenames: Dictionary of image paths and their ids or list of image paths.
+        index: Index of the shard.
+        no_shards: Number of shards.
+
+    Returns:
+        Images of the shard in the same format as `filenames`.
+    """
+    if isinstance(filenames, dict):
+        items = sorted(filenames.items(), key=lambda item: item[1])
+        return dict(items[len(items) * index // no_shards:len(items) * (index + 1) // no_shards])
+
+    filenames = sorted(filenames)
+    return filenames[len(filenames) * index // no_shards:len(filenames) * (index + 1) // no_shards]
+
+
+def merge_records(filenames, merged_filename):
+    """Concatenates files of records with the same dimension, e.g. `.deep-features` files of shards.
+
+    Args:
+        filenames: Locations of the files in the order of merging.
+        merged_filename: Location where to store the merged file.
+    """
+    dimension = None
+    for filename in filenames:
+        with dataset.read_file(filename, HEADER) as f:
+            file_dimension = struct.unpack('<I', f.read(4))[0]
+        if dimension is not None and dimension != file_dimension:
+            raise Exception("Dimension of " + filename + " does not match the other shards.")
+        dimension = file_dimension
+
+    with dataset.create_file(merged_filename, [('<I', dimension)], HEADER) as merged:
+        for filename in filenames:
+            with dataset.read_file(filename, HEADER) as f:
+                f.read(4)
+                shutil.copyfileobj(f, merged, 16 * 1024 * 1024)
+
+
+def merge_sums(filenames, merged_filename):
+    """Sums `.sumX` or `.sumXY` files.
+
+    Args:
+        filenames: Locations of the files.
+        merged_filename: Location where to store the sum.
+    """
+    total = None
+    for filename in filenames:
+        with dataset.read_file(filename, HEADER) as f:
+            dimension = struct.unpack('<I', f.read(4))[0]
+            values = np.frombuffer(f.read(), dtype='<f4').astype(np.float64)
+        total = values if total is None else total + values
+
+    with dataset.create_file(merged_filename, [('<I', dimension)], HEADER) as merged:
+        total.astype('<f4').tofile(merged)
+
+
+def merge_shards(run_name, no_shards):
+    """Merges output files of all shards of a classification run into the standard output files.
+
+    Args:
+        run_name: Path and name of the output files as given to the shards.
+        no_shards: Number of shards.
+    """
+    pt = console.ProgressTracker()
+    shards = [get_shard_run_name(run_name, i, no_shards) for i in range(no_shards)]
+
+    for extension in ['.annotation', '.deep-features', '.softmax']:
+        pt.info(">> Merging " + extension + " files...")
+        merge_records([shard + extension for shard in shards], run_name + extension)
+
+    for extension in ['.sumX', '.sumXY']:
+        if all(os.path.isfile(shard + extension) for shard in shards):
+            pt.info(">> Merging " + extension + " files...")
+            merge_sums([shard + extension for shard in shards], run_name + extension)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--run_name', required=True, help='path and name of the output files of classify.py')
+    parser.add_argument('--shards', type=int, required=True, help='number of shards')
+    args = parser.parse_args()
+
+    merge_shards(args.run_name, args.shards)
@@ -0,0 +1,75 @@
+import time
+import argparse
+
+from common_utils import console, dataset, keyword_model
+
+
+def parse_query(query):
+    """Parses a query in conjunctive normal form.
+
+    Args:
+        query: Clauses separated by semicolon, class ids in each clause separated by comma, e.g. `1,2;3`.
+
+    Returns:
+        List of clauses, each clause is a list of class ids.
+    """
+    return [[int(class_id) for class_id in clause.split(',')] for clause in query.split(';')]
+
+
+def benchmark(rank, query, top_k, repeats):
+    """Measures number of queries per second.
+
+    Args:
+        rank: Ranking method of `KeywordModel`.
+        query: Parsed query.
+        top_k: Number of images to return.
+        repeats: Number of times to run the query.
+    """
+    pt = console.ProgressTracker()
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        rank(query, top_k)
+    duration = time.perf_counter() - start
+
+    pt.info("\t> {:d} queries in {:.3f}s, {:.1f} QPS".format(repeats, duration, repeats / duration))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--index_filename', required=True, help='location of the inverted index file')
+    parser.add_argument('--idf_filename', default=None, help='location of the .sumX file if IDF should be used')
+    parser.add_argument('--query', required=True,
+                        help='clauses separated by semicolon, class ids in each clause separated by comma')
+    parser.add_argument('--top_k', type=int, default=100, help='number of images to return')
+    parser.add_argument('--threshold_algorithm', action='store_true', default=False,
+                        help='stop reading classes once the top_k images are known')
+    parser.add_argument('--next_query', default=None,
+                        help='query of an image following the image of --query in the same video, '
+                             'in the same format as --query')
+    parser.add_argument('--window', type=int, default=4,
+                        help='number of images where to find the image of --next_query, the first image included')
+    parser.add_argument('--videos', default=None,
+                        help='frame manifest of processing/scan_images.py if the window should not cross videos')
+    parser.add_argument('--benchmark', type=int, default=None, help='run the query given number of times')
+    args = parser.parse_args()
+
+    model = keyword_model.KeywordModel(
+        args.index_filename, None if args.idf_filename is None else keyword_model.read_idf(args.idf_filename),
+        None if args.videos is None else dataset.read_video_starts(args.videos)
+    )
+    query = parse_query(args.query)
+
+    if args.next_query:
+        next_query = parse_query(args.next_query)
+
+        def rank(q, top_k):
+            return model.rank_temporal(q, next_query, args.window, top_k)
+    else:
+        rank = model.rank_threshold if args.threshold_algorithm else model.rank
+
+    if args.benchmark:
+        benchmark(rank, query, args.top_k, args.benchmark)
+    else:
+        for image_id, score in zip(*rank(query, args.top_k)):
+            print("{:d} {:f}".format(image_id, score))
@@ -0,0 +1,110 @@
+import argparse
+import numpy as np
+from sklearn.decomposition import PCA
+
+from common_utils import console, dataset
+from common_utils.dataset import DEFAULT_HEADER, REDUCED_FEATURES_MAGIC, REDUCED_FEATURES_HEADER, \
+    REDUCED_FEATURES_DTYPES
+
+
+def normalize(vectors):
+    """
+    Returns:
+        L2 normalized vectors as float32, zero vectors stay zero.
+    """
+    vectors = np.array(vectors, dtype=np.float32)
+    norms = np.sqrt(np.sum(vectors * vectors, axis=1, keepdims=True))
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def fit_pca(features, dimension, sample_size, whiten):
+    """Fits PCA on a random sample of L2 normalized features.
+
+    Args:
+        features: Matrix of features, one row per image.
+        dimension: Number of PCA components.
+        sample_size: Number of features to fit the PCA on.
+        whiten: If True, components are scaled to unit variance.
+
+    Returns:
+        Tuple of PCA mean and components as float32 numpy arrays, the components are whitened if requested.
+    """
+    pt = console.ProgressTracker()
+    pt.info(">> Fitting PCA...")
+
+    sample = np.sort(np.random.RandomState(42).choice(len(features), min(sample_size, len(features)), replace=False))
+    pca = PCA(n_components=dimension, whiten=whiten, random_state=42)
+    pca.fit(normalize(features[sample]))
+    pt.info("\t> Explained variance: {:.3f}".format(np.sum(pca.explained_variance_ratio_)))
+
+    components = pca.components_
+    if whiten:
+        components = components / np.sqrt(pca.explained_variance_)[:, np.newaxis]
+    return pca.mean_.astype(np.float32), components.astype(np.float32)
+
+
+def reduce_features(filename, reduced_filename, dimension=256, dtype=np.float16, sample_size=100000, whiten=False,
+                    block_size=65536):
+    """Reduces deep features by PCA and stores them L2 normalized and quantized.
+
+    Args:
+        filename: Location of the `.deep-features` file.
+        reduced_filename: Location where to store the reduced features.
+        dimension: Number of PCA components.
+        dtype: `np.float16` or `np.int8` used to store the reduced features.
+        sample_size: Number of features to fit the PCA on.
+        whiten: If True, components are scaled to unit variance.
+        block_size: Number of features to reduce at once.
+    """
+    pt = console.ProgressTracker()
+    ids, features = dataset.read_records(filename, DEFAULT_HEADER)
+    dtype = np.dtype(dtype).newbyteorder('<')
+
+    mean, components = fit_pca(features, dimension, sample_size, whiten)
+    dimension = len(components)
+
+    def transform(vectors):
+        return normalize(np.dot(normalize(vectors) - mean, components.T))
+
+    # int8 features share one scale so that their inner products are proportional to the cosine similarity
+    scale = np.float32(1)
+    if dtype == np.int8:
+        sample = np.random.RandomState(42).choice(len(features), min(sample_size, len(features)), replace=False)
+        scale = np.float32(np.amax(np.abs(transform(features[np.sort(sample)]))) / 127)
+
+    header = np.zeros(1, dtype=REDUCED_FEATURES_HEADER)
+    header['count'], header['dimension'], header['original_dimension'] = len(features), dimension, len(mean)
+    header['dtype'] = REDUCED_FEATURES_DTYPES.index(dtype)
+    header['scale'], header['whiten'] = scale, whiten
+
+    pt.info(">> Reducing features...")
+    pt.reset(len(features))
+
+    with dataset.create_file_atomically(reduced_filename, [], DEFAULT_HEADER) as f:
+        f.write(REDUCED_FEATURES_MAGIC)
+        header.tofile(f)
+        mean.astype('<f4').tofile(f)
+        components.astype('<f4').tofile(f)
+        np.asarray(ids, dtype='<u4').tofile(f)
+
+        for start in range(0, len(features), block_size):
+            block = transform(features[start:start + block_size])
+            if dtype == np.int8:
+                block = np.clip(np.round(block / scale), -127, 127)
+            block.astype(dtype).tofile(f)
+            pt.increment(len(block))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', required=True, help='location of the .deep-features file')
+    parser.add_argument('--output', required=True, help='location where to store the reduced features')
+    parser.add_argument('--dimension', type=int, default=256, help='number of PCA components')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'int8'],
+                        help='type used to store the reduced features')
+    parser.add_argument('--sample_size', type=int, default=100000, help='number of features to fit the PCA on')
+    parser.add_argument('--whiten', action='store_true', default=False,
+                        help='scale PCA components to unit variance')
+    args = parser.parse_args()
+
+    reduce_features(args.input, args.output, args.dimension, np.dtype(args.dtype), args.sample_size, args.whiten)
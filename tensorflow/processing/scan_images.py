@@ -0,0 +1,85 @@
+import os
+import argparse
+import numpy as np
+
+from common_utils import console, dataset
+from common_utils.dataset import DEFAULT_HEADER, FRAME_MANIFEST_MAGIC, FRAME_MANIFEST_HEADER, FRAME
+
+
+def update_frame_manifest(directory, manifest_filename, first_id=0, no_threads=16):
+    """Lists images of a folder and stores their ids, sizes and modification times to a frame manifest.
+
+    Images already in the manifest keep their ids. New images and images whose size or modification time
+    changed get new ids larger than all ids ever given, so that they can be classified and added to
+    a segmented index by `processing/update_index.py`. Ids of removed and changed images are not reused.
+
+    Args:
+        directory: Folder with a subfolder of images for every video.
+        manifest_filename: Location of the frame manifest, it is created if it does not exist.
+        first_id: Id of the first new image, e.g. the next id after images of already indexed videos.
+        no_threads: Number of subfolders listed at once.
+
+    Returns:
+        Tuple of the number of new or changed images and the number of removed images.
+    """
+    pt = console.ProgressTracker()
+    paths, sizes, mtimes = dataset.scan_images(os.path.normpath(directory), no_threads=no_threads)
+
+    ids = np.zeros(len(paths), dtype=np.uint32)
+    known = np.zeros(len(paths), dtype=np.bool_)
+    next_id = first_id
+    no_removed = 0
+
+    if os.path.isfile(manifest_filename):
+        pt.info(">> Comparing with the manifest...")
+        records, old_paths, _, old_next_id = dataset.read_frame_manifest(manifest_filename)
+        next_id = max(next_id, old_next_id)
+
+        positions = {path: i for i, path in enumerate(old_paths)}
+        old = np.array([positions.get(path, -1) for path in paths], dtype=np.int64)
+        found = old >= 0
+
+        known[found] = (records['size'][old[found]] == sizes[found]) & \
+            (records['mtime'][old[found]] == mtimes[found])
+        ids[known] = records['id'][old[known]]
+        no_removed = len(records) - int(np.count_nonzero(known))
+
+    first_new_id = next_id
+    ids[~known] = np.arange(first_new_id, first_new_id + np.count_nonzero(~known))
+    next_id = first_new_id + int(np.count_nonzero(~known))
+
+    _write_frame_manifest(manifest_filename, ids, paths, sizes, mtimes, first_new_id, next_id)
+    pt.info("\t> {:d} images, {:d} new or changed, {:d} removed or changed.".format(
+        len(paths), int(np.count_nonzero(~known)), no_removed))
+    return int(np.count_nonzero(~known)), no_removed
+
+
+def _write_frame_manifest(filename, ids, paths, sizes, mtimes, first_new_id, next_id):
+    """Writes frame manifest readable by `dataset.read_frame_manifest`, records are sorted by id."""
+    order = np.argsort(ids, kind='stable')
+    encoded = [paths[i].encode('utf-8', 'surrogateescape') + b'\0' for i in order]
+
+    header = np.zeros(1, dtype=FRAME_MANIFEST_HEADER)
+    header['count'], header['first_new_id'], header['next_id'] = len(ids), first_new_id, next_id
+
+    records = np.zeros(len(ids), dtype=FRAME)
+    records['id'], records['size'], records['mtime'] = ids[order], sizes[order], mtimes[order]
+    records['path'] = np.cumsum([0] + [len(path) for path in encoded])[:-1]
+
+    with dataset.create_file_atomically(filename, [], DEFAULT_HEADER) as f:
+        f.write(FRAME_MANIFEST_MAGIC)
+        header.tofile(f)
+        records.tofile(f)
+        f.write(b''.join(encoded))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', required=True, help='directory with a subdirectory of images for every video')
+    parser.add_argument('--manifest', required=True, help='location of the frame manifest to create or update')
+    parser.add_argument('--first_id', type=int, default=0,
+                        help='id of the first new image, see --next_id of processing/update_index.py')
+    parser.add_argument('--threads', type=int, default=16, help='number of directories listed at once')
+    args = parser.parse_args()
+
+    update_frame_manifest(args.image_dir, args.manifest, args.first_id, args.threads)
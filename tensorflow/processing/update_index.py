@@ -0,0 +1,238 @@
+import os
+import shutil
+import argparse
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+from common_utils import console, dataset
+from common_utils.inverted_index import InvertedIndex, INDEX_MAGIC, INDEX_MAGIC_V2
+from common_utils.segmented_index import read_manifest, write_manifest
+from processing import create_index
+
+
+def add_segment(manifest_filename, filename, chunk_size=64 * 1024 * 1024, version=1, block_size=512, score_bytes=1):
+    """Adds images of new videos to a segmented index as the newest segment, the manifest is created if needed.
+
+    Args:
+        manifest_filename: Location of the manifest of the segmented index.
+        filename: Annotation file of the new images or an inverted index file, e.g. the existing base index.
+            Image ids must be larger than image ids already in the index.
+        chunk_size: Number of bytes of the annotation file to read at once.
+        version: Version of the index file format of the segment, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
+    """
+    pt = console.ProgressTracker()
+    segment, path = _get_segment_name(manifest_filename, _reserve_segment_number(manifest_filename))
+
+    with open(filename, 'rb') as f:
+        is_index = f.read(8) in (INDEX_MAGIC, INDEX_MAGIC_V2)
+
+    if is_index:
+        shutil.copyfile(filename, path)
+        first_id, last_id = _get_id_range(InvertedIndex(path))
+    else:
+        _, ids, _ = dataset.read_annotation_offsets(filename, chunk_size)
+        first_id, last_id = (int(np.amin(ids)), int(np.amax(ids))) if len(ids) > 0 else (None, None)
+        create_index.create_index_file(filename, path, chunk_size, version, block_size, score_bytes)
+
+    with _lock_manifest(manifest_filename):
+        next_segment, segments = read_manifest(manifest_filename)
+        if first_id is None or (len(segments) > 0 and first_id <= max(s[2] for s in segments)):
+            os.remove(path)
+            raise Exception("Image ids of " + filename + " are empty or not larger than image ids in the index.")
+
+        write_manifest(manifest_filename, next_segment, segments + [(segment, first_id, last_id)])
+    pt.info(">> Segment {} with images {:d}-{:d} added.".format(segment, first_id, last_id))
+
+
+def merge_segments(manifest_filename, fan_in=4, full=False, version=1, block_size=512, score_bytes=1):
+    """Merges segments of similar size (tiered compaction), so that number of segments grows logarithmically.
+    Readers that opened the index earlier are not affected, new readers use the merged segments.
+    Segments can be added while merging, only one merge of the index runs at a time.
+
+    Args:
+        manifest_filename: Location of the manifest of the segmented index.
+        fan_in: Number of consecutive segments of the same size tier to merge, size tiers are powers of `fan_in`.
+        full: If true, all segments are merged into one segment that can be used as standard inverted index.
+        version: Version of the index file format of the merged segments, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
+    """
+    pt = console.ProgressTracker()
+    directory = os.path.dirname(manifest_filename)
+
+    with _lock_manifest(manifest_filename, '.merge.lock'):
+        while True:
+            _, segments = read_manifest(manifest_filename)
+            paths = [os.path.join(directory, segment) for segment, _, _ in segments]
+
+            if full:
+                start, stop = 0, len(segments) if len(segments) > 1 else 0
+            else:
+                tiers = [int(np.log(max(os.path.getsize(path), 1)) / np.log(fan_in)) for path in paths]
+                start, stop = _find_merge_run(tiers, fan_in)
+            if stop - start < 2:
+                break
+
+            segment, path = _get_segment_name(manifest_filename, _reserve_segment_number(manifest_filename))
+            pt.info(">> Merging {:d} segments into {}...".format(stop - start, segment))
+            _merge_files(paths[start:stop], path, version, block_size, score_bytes)
+
+            # segments added during the merge are appended, the merged segments keep their position
+            merged = (segment, segments[start][1], max(s[2] for s in segments[start:stop]))
+            with _lock_manifest(manifest_filename):
+                next_segment, current = read_manifest(manifest_filename)
+                if current[start:stop] != segments[start:stop]:
+                    os.remove(path)
+                    raise Exception("Segments of " + manifest_filename + " were changed during the merge.")
+                write_manifest(manifest_filename, next_segment, current[:start] + [merged] + current[stop:])
+
+            for old_path in paths[start:stop]:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pt.info("\t> {} is in use and was not removed.".format(old_path))
+
+
+def get_next_id(manifest_filename):
+    """
+    Returns:
+        Image id that should be used for the first image of new videos.
+    """
+    _, segments = _read_manifest_or_empty(manifest_filename)
+    return max([s[2] + 1 for s in segments] + [0])
+
+
+def _read_manifest_or_empty(manifest_filename):
+    if not os.path.isfile(manifest_filename):
+        return 0, []
+    return read_manifest(manifest_filename)
+
+
+@contextlib.contextmanager
+def _lock_manifest(manifest_filename, suffix='.lock'):
+    """Holds an exclusive lock of a lock file next to the manifest while the manifest is read and rewritten,
+    so that concurrent runs do not reserve the same segment number or drop segments of each other.
+    """
+    with open(manifest_filename + suffix, 'a+') as f:
+        f.seek(0)
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _reserve_segment_number(manifest_filename):
+    """Increases the number of the next segment in the manifest, the manifest is created if needed.
+
+    Returns:
+        Number of a new segment that no other run uses.
+    """
+    with _lock_manifest(manifest_filename):
+        next_segment, segments = _read_manifest_or_empty(manifest_filename)
+        write_manifest(manifest_filename, next_segment + 1, segments)
+    return next_segment
+
+
+def _get_segment_name(manifest_filename, number):
+    """
+    Returns:
+        Tuple of the segment filename relative to the manifest and its path.
+    """
+    segment = "{}.{:d}.segment".format(os.path.basename(manifest_filename), number)
+    return segment, os.path.join(os.path.dirname(manifest_filename), segment)
+
+
+def _get_id_range(index):
+    """
+    Returns:
+        Tuple of the smallest and the largest image id in the index, (None, None) if the index is empty.
+    """
+    first_id, last_id = None, None
+    for class_id in index.classes:
+        ids = index.postings(class_id)['id']
+        if len(ids) > 0:
+            first_id = int(np.amin(ids)) if first_id is None else min(first_id, int(np.amin(ids)))
+            last_id = int(np.amax(ids)) if last_id is None else max(last_id, int(np.amax(ids)))
+    return first_id, last_id
+
+
+def _find_merge_run(tiers, fan_in):
+    """
+    Returns:
+        Tuple of start and stop of the first run of at least `fan_in` consecutive segments of the same tier,
+        (0, 0) if there is no such run.
+    """
+    start = 0
+    for i in range(1, len(tiers) + 1):
+        if i == len(tiers) or tiers[i] != tiers[start]:
+            if i - start >= fan_in:
+                return start, i
+            start = i
+    return 0, 0
+
+
+def _merge_files(filenames, merged_filename, version, block_size, score_bytes):
+    """Merges inverted index files with disjoint image ids into one file.
+
+    Args:
+        filenames: Locations of the index files.
+        merged_filename: Location of the merged index file.
+        version: Version of the index file format, 1 or 2.
+        block_size: Number of postings in a block (version 2 only), must be divisible by 8.
+        score_bytes: Number of bytes of a quantized score, 1 or 2 (version 2 only).
+    """
+    indexes = [InvertedIndex(filename) for filename in filenames]
+    no_classes = max([max(index.classes) + 1 for index in indexes if len(index) > 0] + [0])
+    counts = [sum(index.count(class_id) for index in indexes) for class_id in range(no_classes)]
+
+    def class_postings():
+        for class_id in range(no_classes):
+            postings = np.concatenate([index.postings(class_id) for index in indexes])
+            yield postings[np.argsort(-postings['score'], kind='stable')]
+
+    create_index.write_index_file(merged_filename, counts, class_postings(), version, block_size, score_bytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--manifest', required=True, help='location of the manifest of the segmented index')
+    parser.add_argument('--add', default=None,
+                        help='annotation file of new videos or an index file to add as a new segment')
+    parser.add_argument('--merge', action='store_true', default=False, help='merge segments of similar size')
+    parser.add_argument('--full', action='store_true', default=False, help='merge all segments into one')
+    parser.add_argument('--fan_in', type=int, default=4, help='number of segments of similar size to merge')
+    parser.add_argument('--next_id', action='store_true', default=False,
+                        help='print id of the first image of new videos, see --first_id of classify.py')
+    parser.add_argument('--chunk_size', type=int, default=64, help='MB of the annotation file to read at once')
+    parser.add_argument('--compressed', action='store_true', default=False,
+                        help='create segments in version 2 of the index format')
+    parser.add_argument('--block_size', type=int, default=512, help='number of postings in a compressed block')
+    parser.add_argument('--score_bytes', type=int, default=1, choices=[1, 2],
+                        help='number of bytes of a quantized score in the compressed index')
+    args = parser.parse_args()
+
+    index_version = 2 if args.compressed else 1
+
+    if args.add:
+        add_segment(args.manifest, args.add, args.chunk_size * 1024 * 1024, index_version, args.block_size,
+                    args.score_bytes)
+    if args.merge or args.full:
+        merge_segments(args.manifest, args.fan_in, args.full, index_version, args.block_size, args.score_bytes)
+    if args.next_id:
+        print(get_next_id(args.manifest))
@@ -0,0 +1,247 @@
+import time
+import pickle
+import argparse
+import numpy as np
+from sklearn.cluster import KMeans
+
+from simulations import similarity
+from common_utils import console
+
+
+class IVFPQIndex:
+    """
+    Approximate nearest neighbour index of L2 normalized vectors by inner product.
+    Vectors are assigned to the closest of `n_lists` coarse centroids (inverted file), the residual
+    of each vector to its centroid is encoded by product quantization into `n_subspaces` bytes.
+    """
+
+    def __init__(self, n_lists=1024, n_subspaces=8, n_iterations=20, sample_size=100000, seed=0):
+        """
+        Args:
+            n_lists: number of coarse centroids.
+            n_subspaces: number of bytes used to encode a vector.
+            n_iterations: maximal number of k-means iterations.
+            sample_size: number of vectors used to train the centroids.
+            seed: seed of the random generator used to sample the training vectors.
+        """
+        self.n_lists = n_lists
+        self.n_subspaces = n_subspaces
+        self.n_iterations = n_iterations
+        self.sample_size = sample_size
+        self.seed = seed
+
+        self.dimension = 0
+        self.centroids = None
+        self.codebooks = None
+        self.list_offsets = None
+        self.indexes = None
+        self.codes = None
+
+    def build(self, vectors, block_size=65536):
+        """
+        Trains the quantizers and encodes all vectors.
+
+        Args:
+            vectors: matrix of L2 normalized vectors, one vector per row.
+            block_size: number of vectors to encode at once.
+        """
+        pt = console.ProgressTracker()
+        rng = np.random.RandomState(self.seed)
+
+        self.dimension = vectors.shape[1]
+        sample = np.sort(rng.choice(len(vectors), min(self.sample_size, len(vectors)), replace=False))
+        sample = np.array(vectors[sample], dtype=np.float32)
+
+        pt.info(">> Training coarse quantizer...")
+        self.centroids = self._kmeans(sample, min(self.n_lists, len(sample)))
+        self.n_lists = len(self.centroids)
+
+        pt.info(">> Training product quantizer...")
+        residuals = self._split(sample - self.centroids[_nearest(sample, self.centroids)])
+        self.codebooks = np.stack([
+            self._kmeans(residuals[:, m], min(256, len(sample))) for m in range(self.n_subspaces)
+        ])
+
+        pt.info(">> Encoding vectors...")
+        pt.reset(len(vectors))
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        codes = np.empty([len(vectors), self.n_subspaces], dtype=np.uint8)
+        for start in range(0, len(vectors), block_size):
+            block = np.array(vectors[start:start + block_size], dtype=np.float32)
+            assignment[start:start + len(block)] = _nearest(block, self.centroids)
+            residuals = self._split(block - self.centroids[assignment[start:start + len(block)]])
+            for m in range(self.n_subspaces):
+                codes[start:start + len(block), m] = _nearest(residuals[:, m], self.codebooks[m])
+            pt.increment(len(block))
+
+        # vectors of each list are stored together
+        self.indexes = np.argsort(assignment, kind='stable').astype(np.uint32)
+        self.codes = codes[self.indexes]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.n_lists))])
+
+    def search(self, query, top_k, n_probe=16):
+        """
+        Finds vectors with approximately the largest inner product with a query.
+
+        Args:
+            query: a query vector, e.g. a sum of L2 normalized vectors.
+            top_k: number of vectors to return.
+            n_probe: number of the closest lists to search in.
+        Returns:
+            Tuple.
+            Indexes of the vectors sorted by descending approximate inner product.
+            Approximate inner products of the vectors.
+        """
+        query = np.asarray(query, dtype=np.float32)
+
+        coarse = np.dot(self.centroids, query)
+        empty = self.list_offsets[1:] == self.list_offsets[:-1]
+        lists = np.argsort(np.where(empty, np.inf, -coarse))[:n_probe]
+
+        # positions of all vectors in the probed lists
+        lengths = self.list_offsets[lists + 1] - self.list_offsets[lists]
+        list_of_item = np.repeat(np.arange(len(lists)), lengths)
+        positions = self.list_offsets[lists][list_of_item] + np.arange(len(list_of_item)) - \
+            (np.cumsum(lengths) - lengths)[list_of_item]
+
+        # inner product of the query with every codeword of every subspace
+        lookup = np.einsum('mkd,md->mk', self.codebooks, self._split(query[np.newaxis])[0])
+        scores = coarse[lists][list_of_item] + \
+            lookup[np.arange(self.n_subspaces), self.codes[positions].astype(np.int64)].sum(axis=1)
+
+        if top_k < len(scores):
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return self.indexes[positions[best]].astype(np.int64), scores[best]
+
+    def _kmeans(self, vectors, k):
+        """
+        Returns:
+            Matrix of `k` centroids of the vectors.
+        """
+        kmeans = KMeans(init='k-means++', n_clusters=k, n_init=1, max_iter=self.n_iterations, random_state=self.seed)
+        kmeans.fit(vectors)
+        return kmeans.cluster_centers_.astype(np.float32)
+
+    def _split(self, vectors):
+        """
+        Returns:
+            Vectors padded by zeros and split into `n_subspaces` parts of the same dimension.
+        """
+        sub_dimension = -(-self.dimension // self.n_subspaces)
+        padded = np.zeros([len(vectors), sub_dimension * self.n_subspaces], dtype=np.float32)
+        padded[:, :self.dimension] = vectors
+        return padded.reshape([len(vectors), self.n_subspaces, sub_dimension])
+
+    def save(self, filename):
+        """
+        Args:
+            filename: a location where to store the index.
+        """
+        # attributes are stored instead of the object so that the file does not depend on the module name
+        with open(filename, 'wb') as f:
+            pickle.dump(self.__dict__, f)
+
+    @staticmethod
+    def load(filename):
+        """
+        Args:
+            filename: a location of the index created by `save`.
+        Returns:
+            `IVFPQIndex` object.
+        """
+        index = IVFPQIndex()
+        with open(filename, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+def _nearest(vectors, centroids, block_size=16384):
+    """
+    Returns:
+        Index of the closest centroid by Euclidean distance for every vector.
+    """
+    norms = np.sum(centroids * centroids, axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        assignment[start:start + len(block)] = np.argmin(norms - 2 * np.dot(block, centroids.T), axis=1)
+    return assignment
+
+
+def benchmark(vectors, index, top_k, n_probes, no_queries, rerank=10, seed=0):
+    """
+    Measures recall and latency of the approximate search compared to the exact search.
+    The approximate search is measured alone and with `top_k * rerank` candidates ordered by the exact
+    inner product as in `Similarity.get_rank`.
+
+    Args:
+        vectors: matrix of L2 normalized vectors used to build the index.
+        index: `IVFPQIndex` object.
+        top_k: number of the nearest vectors to find.
+        n_probes: list of numbers of lists to search in.
+        no_queries: number of randomly selected vectors to use as queries.
+        rerank: number of candidates per one nearest vector to order exactly.
+        seed: seed of the random generator used to select the queries.
+    """
+    pt = console.ProgressTracker()
+    queries = np.random.RandomState(seed).randint(0, len(vectors), no_queries)
+
+    pt.info(">> Searching exactly...")
+    exact, durations = [], []
+    for query_index in queries:
+        start = time.perf_counter()
+        scores = np.dot(vectors, vectors[query_index])
+        exact.append(np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(scores) else np.arange(len(scores)))
+        durations.append(time.perf_counter() - start)
+    pt.info("\t> exact: mean {:.2f} ms, 95th percentile {:.2f} ms".format(
+        np.mean(durations) * 1000, np.percentile(durations, 95) * 1000))
+
+    pt.info(">> Searching approximately...")
+    for n_probe in n_probes:
+        for candidates in [top_k, top_k * rerank]:
+            recall, durations = [], []
+            for query_index, exact_indexes in zip(queries, exact):
+                start = time.perf_counter()
+                indexes, _ = index.search(vectors[query_index], candidates, n_probe)
+                if candidates > top_k:
+                    indexes = indexes[np.argsort(-np.dot(vectors[indexes], vectors[query_index]))[:top_k]]
+                durations.append(time.perf_counter() - start)
+                recall.append(len(np.intersect1d(indexes, exact_indexes)) / len(exact_indexes))
+            pt.info("\t> n_probe {:d}, {:d} candidates: recall@{:d} {:.3f}, mean {:.2f} ms, "
+                    "95th percentile {:.2f} ms".format(n_probe, candidates, top_k, np.mean(recall),
+                                                       np.mean(durations) * 1000, np.percentile(durations, 95) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--similarity', type=str, required=True, help='similarity vector filename')
+    parser.add_argument('--ann', type=str, required=True, help='location of the approximate nearest neighbour index')
+    parser.add_argument('--build', action='store_true', default=False, help='build the index and store it')
+    parser.add_argument('--n_lists', type=int, default=1024, help='number of coarse centroids')
+    parser.add_argument('--n_subspaces', type=int, default=8, help='number of bytes used to encode a vector')
+    parser.add_argument('--benchmark', type=int, default=False,
+                        help='number of queries used to compare the index with the exact search')
+    parser.add_argument('--top_k', type=int, default=100, help='number of the nearest vectors to find')
+    parser.add_argument('--n_probes', type=str, default='1,4,16,64',
+                        help='numbers of lists to search in separated by comma')
+    parser.add_argument('--rerank', type=int, default=10,
+                        help='number of candidates per one nearest vector to order by the exact search')
+    args = parser.parse_args()
+
+    s = similarity.Similarity()
+    s.read_vectors(args.similarity)
+    vectors = s.get_vectors(slice(None))
+
+    if args.build:
+        ann = IVFPQIndex(args.n_lists, args.n_subspaces)
+        ann.build(vectors)
+        ann.save(args.ann)
+    else:
+        ann = IVFPQIndex.load(args.ann)
+
+    if args.benchmark:
+        benchmark(vectors, ann, args.top_k, [int(i) for i in args.n_probes.split(',')], args.benchmark,
+                  args.rerank)
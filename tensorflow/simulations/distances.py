@@ -46,7 +46,7 @@ class Distance:
         for i in range(len(samples)):
             for j in range(i + 1, len(samples)):
                 dist = similarity.cos_dist(
-                    self._similarity.vectors[samples[i]], self._similarity.vectors[samples[j]]
+                    self._similarity.get_vectors(samples[i]), self._similarity.get_vectors(samples[j])
                 )
                 dists.append(dist)
             pt.increment(len(samples) - (i+1))
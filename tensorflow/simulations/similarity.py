@@ -1,4 +1,4 @@
-import struct
+import collections
 import numpy as np
 from common_utils import console, dataset
 
@@ -38,36 +38,101 @@ class Similarity:
     A class used to simulate user in similarity search.
     """
 
-    def __init__(self):
-        self.vectors = []
+    def __init__(self, cache_size=512 * 1024 * 1024):
+        """
+        Args:
+            cache_size: maximal number of bytes of distance vectors of query images cached for one searched image.
+        """
+        self.vectors = None
+        self.norms = None
+        self.scale = np.float32(1)
         self.dimension = 0
         self.len = 0
 
-    def read_vectors(self, filename):
+        self.ann = None
+        self.n_probe = 16
+        self.ann_top_k = 1000
+
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+
+    def read_vectors(self, filename, block_size=64 * 1024 * 1024):
         """
-        Loads similarity deep-feature vectors from a file.
+        Memory-maps similarity deep-feature vectors, the vectors are L2 normalized when they are read by norms
+        computed once for each vector. Reduced features created by `processing/reduce_features.py` are used
+        directly in their float16 or int8 representation.
 
         Args:
             filename: vectors' filename.
+            block_size: number of bytes of the vectors' file to compute norms of at once.
         """
         pt = console.ProgressTracker()
+
+        if dataset.is_reduced_features(filename, HEADER):
+            pt.info(">> Reading reduced similarity vectors...")
+            _, self.vectors, self.scale, _, _ = dataset.read_reduced_features(filename, HEADER)
+            self.norms = None
+            self.len, self.dimension = self.vectors.shape
+            return
+
         pt.info(">> Reading similarity vectors...")
+        _, self.vectors = dataset.read_records(filename, HEADER)
+        self.len, self.dimension = self.vectors.shape
+        pt.reset(self.len)
+
+        self.norms = np.empty(self.len, dtype=np.float32)
+        vectors_per_block = max(1, block_size // (4 + 4 * self.dimension))
+        for start in range(0, self.len, vectors_per_block):
+            block = np.array(self.vectors[start:start + vectors_per_block], dtype=np.float32)
+            norms = np.sqrt(np.sum(block * block, axis=1))
+            self.norms[start:start + len(block)] = np.where(norms > 0, norms, 1)
+            pt.increment(len(block))
+
+    def use_ann(self, filename, n_probe=16, top_k=1000):
+        """
+        Use approximate nearest neighbour index instead of the exact search when ranking by similarity.
+        Only `top_k` images are ranked, the searched image not among them has rank `top_k`.
+
+        Args:
+            filename: a location of `ann.IVFPQIndex` built from the same vectors.
+            n_probe: number of the closest lists of the index to search in.
+            top_k: number of images to rank.
+        """
+        # imported here so that the exact search does not depend on sklearn
+        from simulations import ann
 
-        dt = np.dtype(np.float32).newbyteorder("<")
+        self.ann = ann.IVFPQIndex.load(filename)
+        self.n_probe = n_probe
+        self.ann_top_k = top_k
 
-        with dataset.read_file(filename, HEADER) as f:
-            self.dimension = struct.unpack("<I", f.read(4))[0]
-            self.len = 0
+    def get_vectors(self, indexes):
+        """
+        Args:
+            indexes: an index, list of indexes or a slice of vectors.
+        Returns:
+            L2 normalized vector(s) as float32.
+        """
+        vectors = np.asarray(self.vectors[indexes], dtype=np.float32)
+        if self.norms is not None:
+            return vectors / self.norms[indexes][..., np.newaxis]
+        return vectors if self.scale == 1 else vectors * self.scale
+
+    def _dot(self, query_vectors, block_size=65536):
+        """
+        Computes inner products of all vectors with query vector(s), the vectors are normalized or converted
+        from float16 and int8 to float32 in blocks.
 
-            buffer = f.read(4)  # read image id
-            while buffer != b'':
-                buffer = f.read(self.dimension * 4)
-                vec = np.frombuffer(buffer, dtype=dt)
-                self.vectors.append(vec)
-                self.len += 1
-                if self.len % 10000 == 0:
-                    pt.progress_info("\t> Vectors read: {}", [self.len])
-                buffer = f.read(4)  # read image id
+        Args:
+            query_vectors: a float32 vector or a matrix with a query vector in each column.
+        Returns:
+            Vector or matrix of inner products, one row for each vector.
+        """
+        products = np.empty((self.len,) + query_vectors.shape[1:], dtype=np.float32)
+        for start in range(0, self.len, block_size):
+            products[start:start + block_size] = np.dot(self.get_vectors(slice(start, start + block_size)),
+                                                        query_vectors)
+        return products
 
     def get_distance_vector(self, query_index):
         """
@@ -78,25 +143,76 @@ class Similarity:
         Returns:
             Vector of distances to the argument vector.
         """
-        rank = np.zeros(self.len)
-        query_vector = self.vectors[query_index].astype(np.float32)
+        return 1 - self._dot(self.get_vectors(query_index))
+
+    def clear_cache(self):
+        """
+        Removes all cached distance vectors.
+        """
+        self._cache.clear()
+        self._cache_bytes = 0
+
+    def _get_distance_vectors(self, query_index):
+        """
+        Computes distances of all vectors to each query vector. Distance vectors are kept in LRU cache
+        of `self.cache_size` bytes, the missing ones are computed at once.
+
+        Args:
+            query_index: a list of vector indexes.
+        Returns:
+            Dictionary of distance vectors by the vector index.
+        """
+        query_index = [int(index) for index in query_index]
+        missing = [index for index in dict.fromkeys(query_index) if index not in self._cache]
+
+        computed = {}
+        if len(missing) > 0:
+            distances = np.ascontiguousarray(1 - self._dot(self.get_vectors(missing).T).T)
+            computed = dict(zip(missing, distances))
+
+        vectors = {index: computed[index] if index in computed else self._cache[index] for index in query_index}
+
+        for index in query_index:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+
+        for index, distances in computed.items():
+            if distances.nbytes <= self.cache_size:
+                self._cache[index] = distances
+                self._cache_bytes += distances.nbytes
+
+                while self._cache_bytes > self.cache_size:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= evicted.nbytes
+        return vectors
+
+    def _get_distance_sum(self, query_index):
+        """
+        Args:
+            query_index: a list of vector indexes.
+        Returns:
+            Vector of the sums of distances of all vectors to the query vectors.
+        """
+        distances = self._get_distance_vectors(query_index)
 
-        for i in range(self.len):
-            rank[i] = cos_dist(query_vector, self.vectors[i].astype(np.float32))
-        return rank
+        rank_vec = np.zeros(self.len, dtype=np.float32)
+        for index in query_index:
+            rank_vec += distances[int(index)]
+        return rank_vec
 
-    def get_rank(self, query_index, searched_index):
+    def get_rank(self, query_index, searched_index, top_k=None):
         """
         Computes distance and rank of a searched vector(s) to a query vector.
 
         Args:
             query_index: a vector index or list of indexes. If list passed, an average of the vectors is used.
             searched_index: a vector index or list of indexes.
+            top_k: number of the closest vectors to order, all vectors are ordered if None.
         Returns:
             Triple.
             A rank (list of ranks) of the searched vector(s) determined by the query vector.
             A distance (list of distances) of the searched vector(s) to the query vector.
-            A rank of all vectors determined by the query vector.
+            A rank of all vectors (or `top_k` closest vectors) determined by the query vector.
         """
         if not isinstance(searched_index, list):
             searched_index = [searched_index]
@@ -104,69 +220,157 @@ class Similarity:
         if not isinstance(query_index, list):
             query_index = [query_index]
 
-        rank_vec = self.get_distance_vector(query_index[0])
-        for index in query_index[1:]:
-            rank_vec += self.get_distance_vector(index)
+        if self.ann is not None:
+            return self._get_approximate_rank(query_index, searched_index)
+
+        # sum of distances to all query vectors
+        rank_vec = self._get_distance_sum(query_index)
+
+        # vectors with equal distance are ordered by index
+        if top_k is None or top_k >= len(rank_vec):
+            index_vec = np.argsort(rank_vec, kind='stable')
+        else:
+            candidates = np.flatnonzero(rank_vec <= np.partition(rank_vec, top_k - 1)[top_k - 1])
+            index_vec = candidates[np.argsort(rank_vec[candidates], kind='stable')[:top_k]]
 
-        index_vec = np.argsort(rank_vec)
         ret_list = []
         ret_distances = []
 
         for index in searched_index:
-            ret_distances.append(abs(rank_vec[index] - rank_vec[index_vec[0]]))
+            distance = rank_vec[index]
+            ret_distances.append(abs(distance - rank_vec[index_vec[0]]))
+            ret_list.append(int(np.count_nonzero(rank_vec < distance) + np.count_nonzero(rank_vec[:index] == distance)))
+
+        if len(ret_list) == 1:
+            return ret_list[0], ret_distances[0], index_vec
+        return ret_list, ret_distances, index_vec
+
+    def _get_approximate_rank(self, query_index, searched_index):
+        """
+        Computes rank of a searched vector(s) among `self.ann_top_k` vectors found by the approximate
+        nearest neighbour index. The found vectors are ordered by their exact distance.
+
+        Args:
+            query_index: a list of vector indexes.
+            searched_index: a list of vector indexes.
+        Returns:
+            Triple as `get_rank`, the rank of all vectors contains only the found vectors.
+        """
+        query_vector = np.sum(self.get_vectors(query_index), axis=0)
+        index_vec, _ = self.ann.search(query_vector, self.ann_top_k, self.n_probe)
+
+        rank_vec = len(query_index) - np.dot(self.get_vectors(index_vec), query_vector)
+        order = np.argsort(rank_vec)
+        index_vec, rank_vec = index_vec[order], rank_vec[order]
+
+        ret_list = []
+        ret_distances = []
 
+        for index in searched_index:
             array_of_indexes = np.where(index_vec == index)[0]
-            if len(array_of_indexes) != 1:
-                raise Exception("Image ID " + index + " not found in array_of_indexes")
-            ret_list.append(array_of_indexes[0])
+            if len(array_of_indexes) == 1:
+                ret_list.append(array_of_indexes[0])
+                distance = rank_vec[array_of_indexes[0]]
+            else:
+                ret_list.append(self.ann_top_k)
+                distance = len(query_index) - np.dot(self.get_vectors(index), query_vector)
+            ret_distances.append(abs(distance - rank_vec[0]))
 
         if len(ret_list) == 1:
             return ret_list[0], ret_distances[0], index_vec
         return ret_list, ret_distances, index_vec
 
-    def _get_best_rank(self, image_indexes, searched_index, visualization, similarity_settings, n_reranks=1):
+    def _get_rerank_step(self, query_candidates, searched_index, steps, top_k):
+        """
+        Reranks by a query, the result is shared by all settings that use the same query.
+
+        Args:
+            query_candidates: a tuple of vector indexes used as the query.
+            searched_index: index of the searched image.
+            steps: dictionary of already computed reranks of the searched image.
+            top_k: number of the closest vectors to order, the largest display size.
+        Returns:
+            Tuple.
+            A rank and a distance of the searched image as `get_rank`.
+            Indexes of `top_k` closest vectors ordered by the distance to the query.
+            Distances of the `top_k` closest vectors to the searched image.
+        """
+        if query_candidates not in steps:
+            rank, distance, vector = self.get_rank(list(query_candidates), searched_index, top_k)
+            vector = vector[:top_k]
+            steps[query_candidates] = rank, distance, vector, \
+                1 - np.dot(self.get_vectors(vector), self.get_vectors(searched_index))
+        return steps[query_candidates]
+
+    def _get_best_rank(self, image_indexes, searched_index, visualization, similarity_settings):
         """
         Takes initial ordering of a database and, given similarity settings,
         simulates user by iterative search for searched image.
 
+        All settings are evaluated as one tree level by level, distance vectors of new query images
+        of a level are computed at once and reranks by the same query are computed only once.
+
         Args:
             image_indexes: initial ordering of a database.
             searched_index: index of the searched image.
             visualization: `SimilarityVisualization` class or None if visualization is not used.
-            similarity_settings: `SimilaritySettings` class with settings.
-            n_reranks: current depth of recursion.
+            similarity_settings: `SimilaritySettings` class with lists of settings.
         Returns:
-            List of tuples.
+            Dictionary of lists of tuples by (display size, number of closest images).
             A number of reranks and its corresponding rank of the searched image.
         """
-        if max(similarity_settings.n_reranks) < n_reranks:
-            return []
-
-        distances = []
-        for index in image_indexes[:similarity_settings.display_size]:
-            dist = cos_dist(self.vectors[index].astype(np.float32), self.vectors[searched_index].astype(np.float32))
-            distances.append(dist)
-
-        query_candidates = [image_indexes[i] for i in np.argsort(distances)[:similarity_settings.n_closest]]
-        rank, distance, vector = self.get_rank(query_candidates, searched_index)
-
-        if visualization is not None:
-            visualization.new_iteration(vector[0], text=[
-                "S {:d}".format(rank), "d={:}".format(distance)
-            ])
-
-        if distance > 0:
-            l = self._get_best_rank(vector, searched_index, visualization, similarity_settings, n_reranks + 1)
-
-            for rerank in similarity_settings.n_reranks:
-                if rerank == n_reranks:
-                    l.append((n_reranks, rank))
-        else:
+        top_k = max(similarity_settings.display_size)
+        image_distances = 1 - np.dot(self.get_vectors(image_indexes[:top_k]), self.get_vectors(searched_index))
+
+        settings = [(disp_size, n_closest) for disp_size in similarity_settings.display_size
+                    for n_closest in similarity_settings.n_closest]
+        orderings = {setting: (image_indexes, image_distances) for setting in settings}
+        history = {setting: [] for setting in settings}
+        steps = {}
+
+        for n_reranks in range(1, max(similarity_settings.n_reranks) + 1):
+            queries = {}
+            for (disp_size, n_closest), (indexes, distances) in orderings.items():
+                closest = np.argsort(distances[:disp_size])[:n_closest]
+                queries[disp_size, n_closest] = tuple(int(indexes[i]) for i in closest)
+
+            # the approximate search does not use the exact distance vectors
+            if self.ann is None:
+                self._get_distance_vectors([index for query in queries.values() if query not in steps
+                                            for index in query])
+
+            for setting, query in queries.items():
+                rank, distance, indexes, distances = self._get_rerank_step(query, searched_index, steps, top_k)
+                history[setting].append((rank, distance, indexes[0]))
+
+                if distance > 0:
+                    orderings[setting] = indexes, distances
+                else:
+                    del orderings[setting]
+
+        results = {}
+        for setting in settings:
             l = []
-            for rerank in similarity_settings.n_reranks:
-                if rerank >= n_reranks:
-                    l.append((rerank, rank))
-        return l
+            for n_reranks, (rank, distance, best_index) in enumerate(history[setting], 1):
+                if visualization is not None:
+                    visualization.new_iteration(best_index, text=[
+                        "S {:d}".format(rank), "d={:}".format(distance)
+                    ])
+
+                if distance == 0:
+                    for rerank in similarity_settings.n_reranks:
+                        if rerank >= n_reranks:
+                            l.append((rerank, rank))
+
+            # ranks of the last rerank come first
+            for n_reranks in range(len(history[setting]), 0, -1):
+                rank, distance, _ = history[setting][n_reranks - 1]
+                if distance > 0:
+                    for rerank in similarity_settings.n_reranks:
+                        if rerank == n_reranks:
+                            l.append((n_reranks, rank))
+            results[setting] = l
+        return results
 
     def get_best_rank(self, image_indexes, searched_index, similarity_settings, visualization=None):
         """
@@ -181,16 +385,15 @@ class Similarity:
         Returns:
             Dictionary of ranks for each similarity setting.
         """
+        # distance vectors of query images are shared by all settings
+        self.clear_cache()
         ranks = {}
 
-        for disp_size in similarity_settings.display_size:
-            for n_closest in similarity_settings.n_closest:
-                results = self._get_best_rank(image_indexes, searched_index, visualization,
-                                              SimilaritySettings(disp_size, n_closest, similarity_settings.n_reranks))
-
-                for n_reranks, image_rank in results:
-                    text = SimilaritySettings.gen_text_string_from_similarity(disp_size, n_closest, n_reranks)
-                    ranks[text] = image_rank
+        results = self._get_best_rank(image_indexes, searched_index, visualization, similarity_settings)
+        for (disp_size, n_closest), l in results.items():
+            for n_reranks, image_rank in l:
+                text = SimilaritySettings.gen_text_string_from_similarity(disp_size, n_closest, n_reranks)
+                ranks[text] = image_rank
         return ranks
 
 
@@ -1,15 +1,34 @@
 import sys
 import argparse
 import numpy as np
+import scipy.sparse
 from simulations import simulation_utils, similarity, visualization, user_queries
-from common_utils import console, graph_utils
-import random
+from common_utils import console, dataset, graph_utils, window
 import pickle
 import os
-import collections
+import multiprocessing
 from common_utils.dataset import DEFAULT_HEADER
 HEADER = DEFAULT_HEADER
 
+# simulation shared with worker processes, set before the processes are forked
+_shared_simulation = None
+
+
+def _rank_shard(shard):
+    """
+    Ranks a shard of samples in a worker process.
+
+    Args:
+        shard: a tuple (start, stop, query_length_list, rank_str).
+    Returns:
+        Ranks of the samples from `start` to `stop`.
+    """
+    start, stop, query_length_list, rank_str = shard
+    _shared_simulation._ranks = {}
+    _shared_simulation._rank_samples(_shared_simulation.samples[start:stop], _shared_simulation.indexes[start:stop],
+                                     query_length_list, rank_str, show_progress=False)
+    return _shared_simulation._ranks
+
 
 class Simulation:
     """
@@ -29,10 +48,24 @@ class Simulation:
         self.thresholds = [None]
         self.gen_second_image = False
         self.sliding_window = 4
+        self.seed = None
+        self.video_starts = None
+        self.batched = False
+        self.max_batch_memory = 512 * 1024 * 1024
+        self.workers = 1
+
+    def read_keyword(self, filename, dtype=np.float32):
+        """
+        Loads keyword vectors.
 
-    def read_keyword(self, filename):
-        self._images = simulation_utils.Keywords()
+        Args:
+            filename: a location of softmax file.
+            dtype: numpy type used to store the vectors, `np.uint8` implies byte representation.
+        """
+        self._images = simulation_utils.Keywords(dtype)
         self._images.read_images(filename)
+        if self._images.CLASSES.dtype == np.uint8:
+            self.use_byte = True
 
     # region Sample & index generation
 
@@ -61,53 +94,63 @@ class Simulation:
             pt.error("Missing image keyword vectors to generate samples.")
             exit(1)
         pt.info(">> Generating samples...")
-        self.samples = [random.randint(0, len(self._images) - 1) for _ in range(sample_size)]
+        rng = np.random.default_rng(self.seed)
+
+        self.samples = rng.integers(0, len(self._images), sample_size).tolist()
         if self.gen_second_image:
-            self.samples = [
-                (i, min(i + random.randint(0, self.sliding_window), len(self._images) - 1)) for i in self.samples
-            ]
-        self.__gen_indexes(max_query_len, distribution)
+            video_ends = np.full(len(self.samples), len(self._images)) if self.video_starts is None else \
+                window.get_video_ends(self.video_starts, self.samples)
+            second = np.minimum(np.array(self.samples) + rng.integers(0, self.sliding_window + 1, len(self.samples)),
+                                np.minimum(video_ends, len(self._images)) - 1)
+            self.samples = list(zip(self.samples, second.tolist()))
+        self.__gen_indexes(max_query_len, distribution, rng)
 
         with open(filename, 'wb') as f:
             pickle.dump((self.samples, self.indexes), f)
 
-    def __gen_indexes(self, max_query_len, distribution=None):
+    def __gen_indexes(self, max_query_len, distribution=None, rng=None):
         """
         Generates indexes for all samples from a distribution
         by generating i-th best index of images' distribution based on a given distribution.
+        Indexes of a block of samples are drawn at once without replacement by Gumbel-top-k trick.
 
         Args:
             max_query_len: number of indexes to generate.
             distribution: probability distribution over vector classes.
                           If none, indexes are generated directly from images' distribution.
+            rng: `np.random.Generator` object, a new unseeded generator is used if None.
         """
         pt = console.ProgressTracker()
         pt.info(">> Generating random indexes for samples...")
+        rng = np.random.default_rng() if rng is None else rng
+
+        images = np.array([i for index in self.samples for i in (index if isinstance(index, tuple) else [index])],
+                          dtype=np.int64)
+        indexes = np.empty([len(images), max_query_len], dtype=np.int64)
+
+        pt.reset(len(images))
+        block_size = max(1, self.max_batch_memory // (16 * self._images.NO_CLASSES))
+        for start in range(0, len(images), block_size):
+            block = images[start:start + block_size]
+            probabilities = self._images.CLASSES[:, block].T.astype(np.float32)
+
+            if distribution is None:
+                indexes[start:start + len(block)] = simulation_utils.sample_without_replacement(
+                    probabilities, max_query_len, rng)
+            else:
+                ranks = simulation_utils.sample_without_replacement(
+                    np.broadcast_to(distribution, probabilities.shape), max_query_len, rng)
+                cls_indexes = np.argsort(probabilities, axis=1)[:, ::-1]
+                indexes[start:start + len(block)] = np.take_along_axis(cls_indexes, ranks, axis=1)
+            pt.increment(len(block))
+
+        indexes = iter(indexes.tolist())
         self.indexes = []
-
         for index in self.samples:
-            if not isinstance(index, tuple):
-                index = [index]
-
-            l = []
-            for indx in index:
-                image = self._images[indx]
-                dist = image.DISTRIBUTION if distribution is None else distribution
-
-                rand_indexes = []
-                while len(rand_indexes) < max_query_len:
-                    rand = np.random.choice(np.arange(len(dist)), p=dist)
-                    if rand not in rand_indexes:
-                        rand_indexes.append(rand)
-
-                if distribution is not None:
-                    cls_indexes = np.argsort(image.DISTRIBUTION)[::-1]
-                    l.append([cls_indexes[i] for i in rand_indexes])
-                else:
-                    l.append(rand_indexes)
-            if len(l) == 1:
-                l = l[0]
-            self.indexes.append(l)
+            if isinstance(index, tuple):
+                self.indexes.append([next(indexes) for _ in index])
+            else:
+                self.indexes.append(next(indexes))
 
     # endregion
 
@@ -127,7 +170,17 @@ class Simulation:
         self._idf.read_term_count(unnormalized_mean_filename)
         self._idf.compute_idf()
 
-    def use_similarity(self, filename, disp_size, n_closest, n_reranks):
+    def use_videos(self, filename):
+        """
+        Use video boundaries, the second image of a sample is in the same video as the first one.
+
+        Args:
+            filename: a location of frame manifest created by `processing/scan_images.py`.
+        """
+        self.video_starts = dataset.read_video_starts(filename)
+
+    def use_similarity(self, filename, disp_size, n_closest, n_reranks, ann_filename=None, n_probe=16,
+                       cache_size=512 * 1024 * 1024):
         """
         Use similarity reranking.
 
@@ -136,13 +189,19 @@ class Simulation:
             disp_size: a list - display size to use.
             n_closest: a list - number of closest images to use when reranking.
             n_reranks: a list - number of similarity reranks to perform.
+            ann_filename: a location of approximate nearest neighbour index if it should be used.
+            n_probe: number of lists of the approximate nearest neighbour index to search in.
+            cache_size: maximal number of bytes of cached distance vectors of query images in each process.
         """
         self._similarity_settings = similarity.SimilaritySettings(
             disp_size, n_closest, n_reranks
         )
-        self._similarity = similarity.Similarity()
+        self._similarity = similarity.Similarity(cache_size)
         self._similarity.read_vectors(filename)
 
+        if ann_filename:
+            self._similarity.use_ann(ann_filename, n_probe, max(1000, max(disp_size)))
+
     def use_visualization(self, image_dir, filename, no_iterations, no_images):
         """
 
@@ -226,7 +285,7 @@ class Simulation:
         """
         pt = console.ProgressTracker()
 
-        if self.use_byte:
+        if self.use_byte and self._images.CLASSES.dtype != np.uint8:
             pt.info(">> Converting probabilities from floats to bytes...")
             pt.reset(len(self._images.CLASSES))
 
@@ -261,24 +320,141 @@ class Simulation:
             rank_str = ("usr" if query_length_list is None else "sim") + " " + \
                        ("byte" if self.use_byte else "") + " " + str(threshold)
 
-            for image_id, indexes in zip(self.samples, self.indexes):
+            if self.batched and self._can_rank_batched():
                 if query_length_list is None:
                     query_length_list = [None]
 
                 for query_length in query_length_list:
-                    self._rank_image_or_images(image_id, indexes, use_idf=False,
-                                               plot_name=rank_str + ' ' + str(query_length),
-                                               query_length=query_length)
+                    self._rank_batch(query_length, use_idf=False, plot_name=rank_str + ' ' + str(query_length))
                     if self._idf is not None and query_length is not None and query_length > 1:
-                        self._rank_image_or_images(image_id, indexes, use_idf=True,
-                                                   plot_name=rank_str + ' ' + str(query_length) + " idf",
-                                                   query_length=query_length)
-                pt.increment()
+                        self._rank_batch(query_length, use_idf=True,
+                                         plot_name=rank_str + ' ' + str(query_length) + " idf")
+                pt.increment(len(self.samples))
+                continue
+
+            if len(self.samples) > 0 and query_length_list is None:
+                query_length_list = [None]
+
+            if self.workers > 1 and self._visualization is None:
+                self._rank_samples_in_parallel(query_length_list, rank_str)
+            else:
+                self._rank_samples(self.samples, self.indexes, query_length_list, rank_str)
 
         if self._visualization is not None:
             self._visualization.save()
         pt.info(">> Image ranks calculated.")
 
+    def _rank_samples(self, samples, indexes, query_length_list, rank_str, show_progress=True):
+        """
+        Ranks given samples one by one.
+
+        Args:
+            samples: images to rank.
+            indexes: selected indexes for each image.
+            query_length_list: list of query lengths to use, None in the list to use all indexes.
+            rank_str: prefix of the names used as keys in `self._ranks`.
+            show_progress: False if progress should not be shown, e.g. in a worker process.
+        """
+        pt = console.ProgressTracker()
+
+        for image_id, selected_indexes in zip(samples, indexes):
+            for query_length in query_length_list:
+                self._rank_image_or_images(image_id, selected_indexes, use_idf=False,
+                                           plot_name=rank_str + ' ' + str(query_length),
+                                           query_length=query_length)
+                if self._idf is not None and query_length is not None and query_length > 1:
+                    self._rank_image_or_images(image_id, selected_indexes, use_idf=True,
+                                               plot_name=rank_str + ' ' + str(query_length) + " idf",
+                                               query_length=query_length)
+            if show_progress:
+                pt.increment()
+
+    def _rank_samples_in_parallel(self, query_length_list, rank_str):
+        """
+        Ranks samples in `self.workers` forked processes that share keyword and similarity vectors
+        with this process. Ranks of the processes are merged in order of the samples.
+
+        Args:
+            query_length_list: list of query lengths to use, None in the list to use all indexes.
+            rank_str: prefix of the names used as keys in `self._ranks`.
+        """
+        global _shared_simulation
+        pt = console.ProgressTracker()
+
+        shard_size = max(1, -(-len(self.samples) // (self.workers * 8)))
+        shards = [(start, min(start + shard_size, len(self.samples)), query_length_list, rank_str)
+                  for start in range(0, len(self.samples), shard_size)]
+
+        _shared_simulation = self
+        try:
+            with multiprocessing.get_context('fork').Pool(self.workers) as pool:
+                for (start, stop, _, _), ranks in zip(shards, pool.imap(_rank_shard, shards)):
+                    for key, values in ranks.items():
+                        if key not in self._ranks:
+                            self._ranks[key] = []
+                        self._ranks[key].extend(values)
+                    pt.increment(stop - start)
+        finally:
+            _shared_simulation = None
+
+    def _can_rank_batched(self):
+        """
+        Returns:
+            True if all samples can be ranked at once, i.e. there is no similarity reranking,
+            no visualization and no sample consists of two images.
+        """
+        return self._similarity is None and self._visualization is None and \
+            not any(isinstance(image_id, tuple) for image_id in self.samples)
+
+    def _rank_batch(self, query_length, use_idf, plot_name):
+        """
+        Ranks all samples at once by multiplying sparse matrix of queries [samples, classes]
+        by the matrix [classes, images] in blocks limited by `self.max_batch_memory`.
+        Rank of an image is the number of images with strictly higher score plus one.
+
+        Args:
+            query_length: number of indexes of each sample to use, all indexes are used if None.
+            use_idf: True if idf should be used.
+            plot_name: name used as a key in `self._ranks`.
+        """
+        indexes = [i if query_length is None else i[:query_length] for i in self.indexes]
+        lengths = np.array([len(i) for i in indexes], dtype=np.int64)
+        classes = np.concatenate([np.asarray(i, dtype=np.int64) for i in indexes]) if len(indexes) > 0 \
+            else np.zeros(0, np.int64)
+
+        # float32 IDF and scores as in `_get_score`, only the order of summation can differ
+        if use_idf:
+            weights = np.where(np.repeat(lengths, lengths) > 1, self._idf.IDF[classes], 1).astype(self._idf.IDF.dtype)
+        else:
+            weights = np.ones(len(classes), dtype=np.float32)
+
+        queries = scipy.sparse.csr_matrix((weights, (np.repeat(np.arange(len(indexes)), lengths), classes)),
+                                          shape=(len(indexes), self._images.NO_CLASSES))
+        samples = np.array(self.samples, dtype=np.int64)
+
+        no_images = self._images.NO_IMAGES
+        batch_size = max(1, min(len(samples), 1024))
+        block_size = max(1, min(no_images, self.max_batch_memory // (8 * (batch_size + self._images.NO_CLASSES))))
+
+        ranks = []
+        for start in range(0, len(samples), batch_size):
+            batch = queries[start:start + batch_size]
+            targets = samples[start:start + batch_size]
+
+            target_scores = (batch @ self._images.CLASSES[:, targets].astype(np.float32)).diagonal()
+            higher = np.zeros(len(targets), dtype=np.int64)
+
+            for block_start in range(0, no_images, block_size):
+                scores = batch @ self._images.CLASSES[:, block_start:block_start + block_size].astype(np.float32)
+                higher += np.sum(scores > target_scores[:, np.newaxis], axis=1)
+
+            for length, score, count in zip(lengths[start:start + batch_size], target_scores, higher):
+                ranks.append(int(count) + 1 if length > 0 and score != 0 else None)
+
+        if plot_name not in self._ranks:
+            self._ranks[plot_name] = []
+        self._ranks[plot_name].extend(ranks)
+
     def _rank_image_or_images(self, image_id, selected_indexes, use_idf, plot_name, query_length=None):
         if isinstance(image_id, tuple):
             array = self._get_score(
@@ -287,7 +463,7 @@ class Simulation:
             second_image_score = self._get_score(
                 selected_indexes[1] if query_length is None else selected_indexes[1][:query_length], use_idf
             )
-            array *= Simulation._sliding_window(second_image_score, self.sliding_window)
+            array *= window.sliding_window_max(second_image_score, self.sliding_window, self.video_starts)
 
             rank = None
             if array[image_id[0]] != 0:
@@ -304,42 +480,11 @@ class Simulation:
                          use_idf, plot_name)
 
     def _get_score(self, selected_indexes, use_idf):
-        array = np.copy(self._images.CLASSES[selected_indexes[0]])
-
-        if len(selected_indexes) > 1:
-            if use_idf:
-                array = self._idf.IDF[selected_indexes[0]] * self._images.CLASSES[selected_indexes[0]]
+        classes = self._images.CLASSES[selected_indexes].astype(np.float32)
 
-            for i in range(1, len(selected_indexes)):
-                array += self._images.CLASSES[selected_indexes[i]] \
-                    if not use_idf \
-                    else self._idf.IDF[selected_indexes[i]] * self._images.CLASSES[selected_indexes[i]]
-        return array
-
-    @staticmethod
-    def _sliding_window(array, window):
-        result = np.zeros_like(array)
-        deque = collections.deque()
-
-        for i in range(len(array)):
-            val = array[i]
-            while len(deque) > 0 and val > deque[-1]:
-                deque.pop()
-            deque.append(val)
-
-            j = i + 1 - window
-            if j >= 0:
-                result[j] = deque[0]
-                if array[j] == deque[0]:
-                    deque.popleft()
-
-        j += 1
-        while j < len(array):
-            result[j] = deque[0]
-            if array[j] == deque[0]:
-                deque.popleft()
-            j += 1
-        return result
+        if len(selected_indexes) > 1 and use_idf:
+            return np.dot(self._idf.IDF[selected_indexes], classes)
+        return classes.sum(0)
 
     def _rank_image(self, image_id, selected_indexes, use_idf, plot_name):
         """
@@ -428,16 +573,13 @@ class Simulation:
         pt.info(">> Calculating histogram of hits...")
 
         h, h_rand, t, t_rand = [], [], [], []
+        rng = np.random.default_rng(self.seed)
 
         for index, user_indexes in zip(self.samples, self.indexes):
             image = self._images[index]
             indexes = np.argsort(image.DISTRIBUTION)
 
-            rand_indexes = []
-            while len(rand_indexes) < 5:
-                rand = np.random.choice(np.arange(len(image.DISTRIBUTION)), p=image.DISTRIBUTION)
-                if rand not in rand_indexes:
-                    rand_indexes.append(rand)
+            rand_indexes = simulation_utils.sample_without_replacement(image.DISTRIBUTION[np.newaxis], 5, rng)[0]
 
             hits_rand = []
             top_rand = True
@@ -477,6 +619,8 @@ if __name__ == '__main__':
 
     parser.add_argument('--byte', action='store_true', default=False,
                         help='convert keyword vectors to byte representation')
+    parser.add_argument('--keyword_dtype', type=str, default='float32', choices=['float32', 'float16', 'uint8'],
+                        help='type used to store keyword vectors in memory, uint8 implies byte representation')
     parser.add_argument('--idf', type=str, default=False, help='unnormalized mean filename if IDF should be used')
     parser.add_argument('--thresholds', type=str, default=False,
                         help='ignore indexes with values smaller than threshold, multiple thresholds divided by comma, '
@@ -491,6 +635,13 @@ if __name__ == '__main__':
                         help='number of images to use for each reranking as a query')
     parser.add_argument('--n_reranks', type=str, default=False,
                         help='number of similarity reranks to do for each image')
+    parser.add_argument('--ann', type=str, default=False,
+                        help='approximate nearest neighbour index created by simulations/ann.py '
+                             'if it should be used instead of the exact similarity search')
+    parser.add_argument('--n_probe', type=int, default=16,
+                        help='number of lists of the approximate nearest neighbour index to search in')
+    parser.add_argument('--similarity_cache', type=int, default=512,
+                        help='MB of distance vectors of query images cached for each sample in each process')
 
     #
     parser.add_argument('--filename', type=str, default=False,
@@ -507,13 +658,22 @@ if __name__ == '__main__':
                         help='various lengths of queries to generate separated by comma')
     parser.add_argument('--gen_second_image', action='store_true', default=False,
                         help='generate second image and rank based on joined ranking of those two images')
+    parser.add_argument('--videos', type=str, default=False,
+                        help='frame manifest of processing/scan_images.py if the second image should be '
+                             'in the same video as the first one')
 
     parser.add_argument('--label_file', type=str, default=False, help='standard label file')
     parser.add_argument('--log_file', type=str, default=False, help='log file of user generated queries')
     parser.add_argument('--use_user_dist', action='store_true', default=False,
                         help='generate samples from distribution given by user queries')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random generator of samples')
 
     parser.add_argument('--rank', action='store_true', default=False, help='perform ranking')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used for ranking if visualization is not used')
+    parser.add_argument('--batched', action='store_true', default=False,
+                        help='rank all samples at once if similarity and visualization is not used, '
+                             'images with the same score are ranked in favour of the searched image')
     parser.add_argument('--graph', action='store_true', default=False, help='graph results')
     parser.add_argument('--class_histogram', action='store_true', default=False,
                         help='graph histogram of selected classes')
@@ -528,7 +688,13 @@ if __name__ == '__main__':
     u = Simulation()
 
     u.use_byte = args.byte
+    u.batched = args.batched
+    u.workers = args.workers
     u.gen_second_image = args.gen_second_image
+    u.seed = args.seed
+
+    if args.videos:
+        u.use_videos(args.videos)
 
     if args.idf:
         u.use_idf(args.idf)
@@ -547,7 +713,7 @@ if __name__ == '__main__':
         u.samples, u.indexes = user_queries.parse_queries(args.log_file, args.label_file)
 
     if args.keyword:
-        u.read_keyword(args.keyword)
+        u.read_keyword(args.keyword, np.dtype(args.keyword_dtype))
 
     if args.gen_samples:
         if not args.filename or not args.query_lengths:
@@ -575,7 +741,8 @@ if __name__ == '__main__':
         u.use_similarity(args.similarity,
                          [int(i) for i in args.disp_size.split(',')],
                          [int(i) for i in args.n_closest.split(',')],
-                         [int(i) for i in args.n_reranks.split(',')])
+                         [int(i) for i in args.n_reranks.split(',')],
+                         args.ann, args.n_probe, args.similarity_cache * 1024 * 1024)
 
     if args.rank:
         if not args.keyword or len(u.samples) == 0:
@@ -21,13 +21,19 @@ class KeywordVector:
 
 class Keywords:
     """
-    A class holding label distributions.
+    A class holding label distributions as a matrix [classes, images].
     """
 
-    def __init__(self):
+    def __init__(self, dtype=np.float32):
+        """
+        Args:
+            dtype: Numpy type of the matrix, `np.float32`, `np.float16` or `np.uint8`.
+                   Values are multiplied by 255 and rounded if `np.uint8` is used.
+        """
         self.NO_CLASSES = 0
         self.NO_IMAGES = 0
-        self.CLASSES = dict()
+        self.CLASSES = None
+        self.dtype = np.dtype(dtype)
 
     def __getitem__(self, key):
         """
@@ -36,90 +42,103 @@ class Keywords:
         """
         kv = KeywordVector()
         kv.ID = key
-        kv.DISTRIBUTION = np.zeros(self.NO_CLASSES, dtype=np.dtype(np.float32))
-        for i in range(self.NO_CLASSES):
-            kv.DISTRIBUTION[i] = self.CLASSES[i][key]
+        kv.DISTRIBUTION = self.CLASSES[:, key].astype(np.float32)
         kv.DISTRIBUTION /= np.sum(kv.DISTRIBUTION)
         return kv
 
     def __len__(self):
         return self.NO_IMAGES
 
-    def read_images(self, filename):
+    def get_class(self, class_id):
         """
-        Reads index of image mappings [images, classes] from a file.
+        Returns:
+            Values of all images for given class without copying the data.
         """
-        if os.path.isfile(filename + ".inverted"):
-            self._read_inverted_index(filename + ".inverted")
-            return
-
-        images = dict()
-        dt = np.dtype(np.float32).newbyteorder("<")
-
-        with dataset.read_file(filename, HEADER) as f:
-            self.NO_CLASSES = struct.unpack("<I", f.read(4))[0]
-            id_no = f.read(4)
-
-            pt = console.ProgressTracker()
-            pt.info(">> Reading image vectors...")
+        return self.CLASSES[class_id]
 
-            self.NO_IMAGES = 0
-            while id_no != b'':
-                kv = KeywordVector()
-                kv.ID = struct.unpack("<I", id_no)[0]
-                kv.DISTRIBUTION = np.frombuffer(f.read(self.NO_CLASSES * 4), dtype=dt)
-                self.NO_IMAGES += 1
-
-                images[kv.ID] = kv
-                id_no = f.read(4)
+    def get_image(self, image_id):
+        """
+        Returns:
+            Unnormalized values of all classes for given image without copying the data.
+        """
+        return self.CLASSES[:, image_id]
 
-        self._invert_index(filename + ".inverted", images)
+    def read_images(self, filename):
+        """
+        Reads index of image mappings [images, classes] from a file.
+        Inverted index [classes, images] is cached in `filename`.inverted file.
+        """
+        if not os.path.isfile(filename + ".inverted"):
+            self._invert_index(filename, filename + ".inverted")
+        self._read_inverted_index(filename + ".inverted")
 
-    def _invert_index(self, filename, images):
+    def _invert_index(self, filename, inverted_filename, block_size=64 * 1024 * 1024):
         """
         Inverts index from [images, classes] to [classes, images] for faster access.
+        The images are transposed in blocks directly into the memory-mapped inverted index file.
 
         Args:
-            filename: location where to store the inverted index.
-            images: numpy array of [images, classes]
+            filename: location of the softmax file.
+            inverted_filename: location where to store the inverted index.
+            block_size: number of bytes of the softmax file to transpose at once.
         """
         pt = console.ProgressTracker()
 
-        if not os.path.isfile(filename):
-            pt.info(">> Inverting image vectors...")
-            pt.reset(self.NO_CLASSES)
+        image_ids, images = dataset.read_records(filename, HEADER)
+        no_images, no_classes = images.shape
 
-            for i in range(self.NO_CLASSES):
-                self.CLASSES[i] = np.zeros(len(images))
-                for image in images.values():
-                    self.CLASSES[i][image.ID] = image.DISTRIBUTION[i]
-                pt.increment()
-            pt.info(">> Saving inverted vectors...")
-            pt.reset(self.NO_CLASSES)
+        pt.info(">> Inverting image vectors...")
+        pt.reset(no_images)
+
+        with dataset.create_file_atomically(inverted_filename, [("<I", no_classes), ("<I", no_images)], HEADER) as f:
+            offset = f.tell()
+            f.truncate(offset + no_classes * no_images * 4)
+
+            classes = np.memmap(f.name, dtype=np.dtype(np.float32).newbyteorder("<"), mode='r+', offset=offset,
+                                shape=(no_classes, no_images))
+
+            images_per_block = max(1, block_size // (4 + 4 * no_classes))
+            for start in range(0, no_images, images_per_block):
+                block = images[start:start + images_per_block]
+                ids = np.array(image_ids[start:start + images_per_block])
 
-            with dataset.create_file(filename, [("<I", len(self.CLASSES)), ("<I", len(self.CLASSES[0]))], HEADER) as f:
-                for i in range(self.NO_CLASSES):
-                    f.write(struct.pack("<" + "f" * len(self.CLASSES[i]), *self.CLASSES[i]))
-                    pt.increment()
+                if len(ids) > 0 and ids[0] == start and ids[-1] == start + len(ids) - 1 and \
+                        np.all(np.diff(ids.astype(np.int64)) == 1):
+                    classes[:, start:start + len(ids)] = block.T
+                else:
+                    if np.any(ids >= no_images):
+                        raise Exception("Image ID larger than number of images in " + filename)
+                    classes[:, ids] = block.T
+                pt.increment(len(ids))
+
+            classes.flush()
+            del classes
 
     def _read_inverted_index(self, filename):
         """
-        Reads inverted index and stores it into `self.CLASSES`.
+        Memory-maps inverted index to `self.CLASSES`.
+        Changes of the matrix are not written back to the file.
         """
         pt = console.ProgressTracker()
 
         with dataset.read_file(filename, HEADER) as f:
             pt.info(">> Reading inverted vectors...")
             self.NO_CLASSES = struct.unpack("<I", f.read(4))[0]
+            self.NO_IMAGES = struct.unpack("<I", f.read(4))[0]
+            offset = f.tell()
 
+        self.CLASSES = np.memmap(filename, dtype=np.dtype(np.float32).newbyteorder("<"), mode='c', offset=offset,
+                                 shape=(self.NO_CLASSES, self.NO_IMAGES))
+
+        if self.dtype != np.float32:
+            pt.info(">> Converting inverted vectors to {}...".format(self.dtype.name))
             pt.reset(self.NO_CLASSES)
-            self.NO_IMAGES = struct.unpack("<I", f.read(4))[0]
 
-            dt = np.dtype(np.float32).newbyteorder("<")
+            classes = np.empty([self.NO_CLASSES, self.NO_IMAGES], dtype=self.dtype)
             for i in range(self.NO_CLASSES):
-                self.CLASSES[i] = np.frombuffer(f.read(self.NO_IMAGES * 4), dtype=dt)
-                self.CLASSES[i].setflags(write=1)
+                classes[i] = np.round(self.CLASSES[i] * 255) if self.dtype == np.uint8 else self.CLASSES[i]
                 pt.increment()
+            self.CLASSES = classes
 
 
 class IDF:
@@ -158,6 +177,29 @@ class IDF:
             print(str(self.TERM_COUNT[i]) + " -> " + str(self.IDF[i]))
 
 
+def sample_without_replacement(probabilities, k, rng):
+    """
+    Draws `k` distinct classes for each row of probabilities by Gumbel-top-k trick, the classes are ordered
+    as if drawn one by one from the probabilities with already drawn classes removed.
+
+    Args:
+        probabilities: matrix [rows, classes] of unnormalized probabilities.
+        k: number of classes to draw for each row, at most the number of classes.
+        rng: `np.random.Generator` object.
+    Returns:
+        Matrix [rows, k] of class indexes.
+    """
+    with np.errstate(divide='ignore'):
+        keys = np.log(probabilities) + rng.gumbel(size=np.shape(probabilities))
+
+    if k < keys.shape[1]:
+        best = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+    else:
+        best = np.tile(np.arange(keys.shape[1]), (len(keys), 1))
+    order = np.argsort(-np.take_along_axis(keys, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+
 def __copy_image_files_to_one_dir(from_dir, to_dir):
     """
     Copies files from video directories to one directory and renames them.